@@ -0,0 +1,73 @@
+import os
+import time
+import logging
+import threading
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+LOGGER = logging.getLogger(__name__)
+
+
+class ConfigWatcher(threading.Thread):
+    """ Call callback(path) when the file changes.
+
+    Uses inotify when inotify_simple is installed, otherwise polls the file every `interval` seconds.
+    The directory is watched, so editors that save by renaming a temporary file are seen too.
+    """
+
+    def __init__(self, path, callback, interval=1.0, settle=0.2):
+        super().__init__(name="ConfigWatcher", daemon=True)
+        self.path = os.path.abspath(path)
+        self.callback = callback
+        self.interval = interval
+        self.settle = settle
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+            return st.st_mtime_ns, st.st_size, st.st_ino
+        except OSError:
+            return None
+
+    def _changed(self):
+        # Let the writer finish, then collapse the burst of events into one reload
+        time.sleep(self.settle)
+        try:
+            self.callback(self.path)
+        except Exception as e:
+            LOGGER.error(f"Reload of {self.path} failed: {e}")
+
+    def run(self):
+        if INotify is not None:
+            try:
+                self._run_inotify()
+                return
+            except OSError as e:
+                LOGGER.warning(f"inotify not available ({e}), polling {self.path}")
+        self._run_polling()
+
+    def _run_inotify(self):
+        inotify = INotify()
+        directory, name = os.path.split(self.path)
+        inotify.add_watch(directory, flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE)
+        while not self.stopped.is_set():
+            events = inotify.read(timeout=int(self.interval * 1000))
+            if any(event.name == name for event in events):
+                self._changed()
+                inotify.read(timeout=0)
+
+    def _run_polling(self):
+        last = self._stat()
+        while not self.stopped.wait(self.interval):
+            current = self._stat()
+            if current and current != last:
+                self._changed()
+                current = self._stat()
+            last = current
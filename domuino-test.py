@@ -2,6 +2,28 @@ import unittest
 import multi_serial_port
 import yaml
 import collections
+import tempfile
+import types
+import os
+import importlib.util
+import time
+import threading
+import queue
+import json
+import logging
+import domusim
+import eventlog
+import shutil
+import sensorstore
+import nodestate
+import liveness
+import urllib.request
+from unittest import mock
+from eventloop import TimerWheel
+from scheduler import PacketScheduler
+from framing import FrameDecoder
+from configwatch import ConfigWatcher
+import crc16
 
 CONFIG_LCDPRINT = yaml.load("""
 ARDUINO_TEST:
@@ -103,6 +125,26 @@ class TestDomuino(unittest.TestCase):
         self.assertEqual(result[0].crc, None)
         self.assertEqual(result[0].data, b'\xa4\x00\x00\x00\x00\x00\x00\x00\x00\x01\x00\x00')
 
+    def test_execute_switch_prebuilt(self):
+        value = {'node': 36097, 'msg': 'SWITCH', 'state': [0, 1, 0, 0, 0, 0, 0]}
+        first = multi_serial_port.execute(dict(value), CONFIG_SWITCH)
+        second = multi_serial_port.execute(dict(value), CONFIG_SWITCH)
+        self.assertEqual(first[0].data, b'\xa4\x00\x00\x00\x00\x00\x00\x00\x01\x00\x00\x00')
+        self.assertIs(first[0], second[0])
+
+    def test_execute_unconfigured(self):
+        value = {'node': 36097, 'msg': 'DHT', 'temperature': 0.0, 'humidity': 0.0}
+        self.assertFalse(multi_serial_port.execute(value, CONFIG_SWITCH))
+        self.assertEqual(value['type'], "[UNCONFIGURED]->HUB")
+
+    def test_command_template(self):
+        template = multi_serial_port.CommandTemplate(36097, "LCDPRINT", [5, 2, 1, "{temperature:0>4.1f}", "C"])
+        self.assertEqual(template.parts[0], b'\x92\x05\x02\x01')
+        self.assertEqual(template({'temperature': 7.25})[0].data, b'\x92\x05\x02\x0107.2C')
+        with self.assertLogs("multi_serial_port", logging.WARNING) as logs:
+            template({'temperature': 123456789.0})
+        self.assertIn("LCDPRINT to 36097 exceeds", logs.output[0])
+
     def test_preparecommand_simple(self):
         result = multi_serial_port.prepare_commands("ARDUINO_TEST", 'MEM', CONFIG_LCDPRINT)
         self.assertIsInstance(result[0], multi_serial_port.Packet)
@@ -130,5 +172,586 @@ class TestDomuino(unittest.TestCase):
         self.assertEqual(result[1].data, b'\x92\x00\x00\x00Temp:10.0')
 
 
+class TestReload(unittest.TestCase):
+    def setUp(self):
+        self.config = multi_serial_port.config
+        self.nets = multi_serial_port.net_reverseid
+        fd, self.path = tempfile.mkstemp(suffix=".yaml")
+        os.close(fd)
+
+    def tearDown(self):
+        # reload_config() rebinds all of them
+        multi_serial_port.config = self.config
+        multi_serial_port.net_reverseid = self.nets
+        multi_serial_port.NODES.names = self.nets
+        os.remove(self.path)
+
+    def reload(self, text):
+        with open(self.path, "w") as f:
+            f.write(text)
+        return multi_serial_port.reload_config(self.path)
+
+    def test_incremental(self):
+        first = self.reload(CONFIG_TEXT)
+        # LIGHT1 is the same as in ms-config.yaml
+        self.assertEqual(sorted(first.changed), ["SW1", "SW2"])
+        second = self.reload(CONFIG_TEXT.replace("net: 21", "net: 22"))
+        self.assertEqual(second.changed, ["SW2"])
+        self.assertIs(second.nodes["SW1"], first.nodes["SW1"])
+        self.assertIs(multi_serial_port.rule_index(multi_serial_port.config), second)
+        third = self.reload(CONFIG_TEXT.replace("net: 21", "net: 22").replace("net: 100", "net: 101"))
+        # SW1 sends to LIGHT1, its packets must follow the new net
+        self.assertEqual(sorted(third.changed), ["LIGHT1", "SW1"])
+        result = multi_serial_port.execute({'node': 20, 'msg': 'SWITCH', 'state': [1]}, multi_serial_port.config)
+        self.assertEqual(result[0].dest, 101)
+
+    def test_watcher(self):
+        self.reload(CONFIG_TEXT)
+        indexes = queue.Queue()
+
+        def reload(path):
+            try:
+                indexes.put(multi_serial_port.reload_config(path))
+            except Exception:
+                indexes.put(None)
+                raise
+
+        def write(path, text):
+            with open(path, "w") as f:
+                f.write(text)
+
+        with mock.patch("configwatch.INotify", None):
+            watcher = ConfigWatcher(self.path, reload, interval=0.02, settle=0.02)
+            watcher.start()
+            try:
+                write(self.path, CONFIG_TEXT.replace("net: 21", "net: 22"))
+                self.assertEqual(indexes.get(timeout=2).changed, ["SW2"])
+                # Editors save to a temporary file and rename it over the old one
+                write(self.path + ".tmp", CONFIG_TEXT.replace("net: 100", "net: 101"))
+                os.replace(self.path + ".tmp", self.path)
+                self.assertEqual(sorted(indexes.get(timeout=2).changed), ["LIGHT1", "SW1", "SW2"])
+                config = multi_serial_port.config
+                with self.assertLogs("configwatch", logging.ERROR):
+                    write(self.path, "SW1: {net: [20")
+                    self.assertIsNone(indexes.get(timeout=2))
+                    self.assertIs(multi_serial_port.config, config)
+                    # Still watching: the error is logged by then
+                    write(self.path, CONFIG_TEXT)
+                    self.assertEqual(sorted(indexes.get(timeout=2).changed), ["LIGHT1", "SW1"])
+            finally:
+                watcher.stop()
+                watcher.join()
+
+
+CONFIG_TEXT = """
+SW1:
+  net: 20
+  SWITCH:
+    1: [{"LIGHT1": {"LIGHT": [1, 0, 0]}}]
+SW2:
+  net: 21
+LIGHT1:
+  net: 100
+"""
+
+
+class TestRoutingTable(unittest.TestCase):
+    def test_routes(self):
+        buses = [types.SimpleNamespace(port=types.SimpleNamespace(name=name)) for name in ("/dev/ttyr00", "/dev/ttyr01")]
+        routes = multi_serial_port.RoutingTable(buses)
+        routes.seed({"A": {"net": 10, "bus": "/dev/ttyr01"}, "B": {"net": 11, "bus": 0}, "C": {"net": 12}})
+        self.assertEqual(routes.lookup(10), [buses[1]])
+        self.assertEqual(routes.lookup(11), [buses[0]])
+        self.assertEqual(routes.lookup(12), buses)
+        self.assertEqual(routes.lookup(255), buses)
+        routes.learn(10, buses[0])
+        routes.learn(12, buses[1])
+        self.assertEqual(routes.lookup(10), [buses[0]])
+        self.assertEqual(routes.lookup(12), [buses[1]])
+
+
+class TestBootloader(unittest.TestCase):
+    def test_record_after_flash(self):
+        with mock.patch.object(multi_serial_port, "record_boot_baudrate") as record, \
+                mock.patch.object(multi_serial_port, "shell", return_value=1):
+            self.assertFalse(multi_serial_port.flash_bootloader("optiboot.hex", 36097, 115200))
+            record.assert_not_called()
+        with mock.patch.object(multi_serial_port, "record_boot_baudrate") as record, \
+                mock.patch.object(multi_serial_port, "shell", return_value=0):
+            multi_serial_port.compile_bootloader("make", "sloeber", 36097, ".", 115200)
+            record.assert_not_called()
+            self.assertTrue(multi_serial_port.flash_bootloader("optiboot.hex", 36097, 115200))
+            record.assert_called_once_with(36097, 115200)
+
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        self.sent = []
+        self.scheduler = PacketScheduler(TimerWheel(), lambda p, again: self.sent.append((p.dest, p.data[0], again)),
+                                         window=2)
+
+    def test_one_outstanding_per_node(self):
+        self.scheduler.extend([multi_serial_port.Packet(b'\x90', dest=10),
+                               multi_serial_port.Packet(b'\x91', dest=10),
+                               multi_serial_port.Packet(b'\x90', dest=11)])
+        self.scheduler.pump()
+        self.assertEqual(self.sent, [(10, 0x90, 0), (11, 0x90, 0)])
+        self.assertIsNone(self.scheduler.acknowledge(10, 0x91))
+        self.assertEqual(self.scheduler.acknowledge(10, 0x90).dest, 10)
+        self.scheduler.pump()
+        self.assertEqual(self.sent[-1], (10, 0x91, 0))
+
+    def test_window(self):
+        self.scheduler.extend([multi_serial_port.Packet(b'\x90', dest=n) for n in (10, 11, 12)])
+        self.scheduler.pump()
+        self.assertEqual(len(self.sent), 2)
+        self.scheduler.acknowledge(11, 0x90)
+        self.scheduler.pump()
+        self.assertEqual(self.sent[-1], (12, 0x90, 0))
+        self.assertEqual(len(self.scheduler), 2)
+
+    def test_broadcast_alone(self):
+        self.scheduler.extend([multi_serial_port.Packet(b'\x90', dest=10),
+                               multi_serial_port.Packet(b'\x81', dest=255)])
+        self.scheduler.pump()
+        self.assertEqual(self.sent, [(10, 0x90, 0)])
+        self.scheduler.acknowledge(10, 0x90)
+        self.scheduler.pump()
+        self.assertEqual(self.sent[-1], (255, 0x81, 0))
+        self.assertEqual(self.scheduler.acknowledge(42, 0xA3).dest, 255)
+
+    def test_reply_slot(self):
+        timers = TimerWheel(tick=0.001)
+        times = []
+        scheduler = PacketScheduler(timers, lambda p, again: (self.sent.append((p.dest, p.data[0], again)),
+                                                              times.append(time.monotonic())),
+                                    window=2, retry_delay=0.01, frame=0.005)
+        scheduler.extend([multi_serial_port.Packet(b'\x90', dest=n) for n in (10, 11, 12)])
+        scheduler.pump()
+        # Half duplex: the ACK of node 10 could come while the hub sends to node 11
+        self.assertEqual(self.sent, [(10, 0x90, 0)])
+        scheduler.acknowledge(10, 0x90)
+        scheduler.pump()
+        self.assertEqual(self.sent[-1], (11, 0x90, 0))
+        # Node 11 is silent: node 12 goes after its reply slot, and every retry after the slot of the last send
+        deadline = time.monotonic() + 0.2
+        while len(self.sent) < 5 and time.monotonic() < deadline:
+            time.sleep(0.001)
+            timers.advance()
+            scheduler.pump()
+        self.assertIn((12, 0x90, 0), self.sent)
+        for previous, sent in zip(times[1:], times[2:]):
+            self.assertGreaterEqual(sent - previous, 2 * 0.005 + 0.01)
+
+
+class TestLiveness(unittest.TestCase):
+    def setUp(self):
+        self.sent = []
+        self.expired = []
+        self.health = liveness.Liveness(probe_interval=0.01)
+        self.timers = TimerWheel(tick=0.001)
+        self.scheduler = PacketScheduler(self.timers, lambda p, again: self.sent.append((p.dest, p.data[0], again)),
+                                         expired=self.expired.append, health=self.health,
+                                         probe=multi_serial_port.Bus.probe)
+
+    def test_states(self):
+        self.health.failed(10)
+        self.assertEqual(self.health.state(10), liveness.SUSPECT)
+        self.assertTrue(self.health.allow(10))
+        self.health.failed(10)
+        self.health.failed(10)
+        self.assertEqual(self.health.state(10), liveness.DOWN)
+        self.assertFalse(self.health.allow(10))
+        self.health.seen(10)
+        self.assertEqual(self.health.state(10), liveness.UP)
+
+    def test_adaptive_timeout(self):
+        self.assertEqual(self.health.timeout(10, 0.5), 0.5)
+        self.health.acked(10, 0.05)
+        self.assertAlmostEqual(self.health.retry_delay(10, 0.03), 0.15)
+        # A slow node gets its 4 sends even past the configured timeout
+        self.assertAlmostEqual(self.health.timeout(10, 0.5, 0.03), 0.6)
+        self.health.acked(11, 0.004)
+        self.assertEqual(self.health.retry_delay(11, 0.03), 0.03)
+        # A fast node up or suspect keeps the whole retry budget of the configured timeout
+        self.assertAlmostEqual(self.health.timeout(11, 0.5, 0.03), 0.5)
+        self.health.failed(11)
+        self.assertEqual(self.health.state(11), liveness.SUSPECT)
+        self.assertAlmostEqual(self.health.timeout(11, 0.5, 0.03), 0.5)
+        # The probe of a down node is short
+        for _ in range(3):
+            self.health.failed(11)
+        self.assertAlmostEqual(self.health.timeout(11, 0.5, 0.03), liveness.MIN_TIMEOUT)
+
+    def test_defer(self):
+        for _ in range(3):
+            self.health.failed(10)
+        self.scheduler.extend([multi_serial_port.Packet(b'\x90', dest=10), multi_serial_port.Packet(b'\x90', dest=11)])
+        self.scheduler.pump()
+        self.assertEqual(self.sent, [(11, 0x90, 0)])
+        self.health.seen(10)
+        self.scheduler.pump()
+        self.assertEqual(self.sent[-1], (10, 0x90, 0))
+
+    def test_hold(self):
+        self.scheduler.hold = 0.02
+        for _ in range(3):
+            self.health.failed(10)
+        light = multi_serial_port.QUERIES['LIGHT']
+        self.scheduler.extend([multi_serial_port.Packet(bytes([light, 1]), dest=10)] * 2)
+        self.scheduler.pump()
+        time.sleep(0.03)
+        self.scheduler.submit(multi_serial_port.Packet(bytes([light, 2]), dest=10))
+        self.timers.advance()
+        # The toggles pressed during the outage expire, the last one is still held
+        self.assertEqual((len(self.expired), len(self.scheduler)), (2, 1))
+        self.health.seen(10)
+        self.scheduler.pump()
+        self.assertEqual(self.sent, [(10, light, 0)])
+        self.assertEqual(self.scheduler.inflight[10].packet.data[1], 2)
+
+    def test_fail_fast(self):
+        self.scheduler.defer = False
+        for _ in range(3):
+            self.health.failed(10)
+        self.scheduler.submit(multi_serial_port.Packet(b'\x90', dest=10))
+        self.scheduler.pump()
+        self.assertEqual((self.sent, len(self.expired), len(self.scheduler)), ([], 1, 0))
+
+    def test_probe(self):
+        for _ in range(3):
+            self.health.failed(10)
+        self.scheduler._arm_probe()
+        time.sleep(0.02)
+        self.timers.advance()
+        self.assertEqual(self.sent, [(10, multi_serial_port.QUERIES['PING'], 0)])
+        self.scheduler.acknowledge(10, multi_serial_port.QUERIES['PING'])
+        self.assertEqual(self.health.state(10), liveness.UP)
+
+
+class TestSharedLiveness(unittest.TestCase):
+    def test_probe_own_nodes(self):
+        health = liveness.Liveness(probe_interval=0.01)
+        timers = TimerWheel(tick=0.001)
+        sent = {'A': [], 'B': []}
+        schedulers = {name: PacketScheduler(timers, lambda p, again, name=name: sent[name].append(p.dest),
+                                            health=health, probe=multi_serial_port.Bus.probe,
+                                            owns=lambda net, name=name: (net == 10) == (name == 'A'))
+                      for name in sent}
+        for net in (10, 20):
+            for _ in range(3):
+                health.failed(net)
+        for scheduler in schedulers.values():
+            scheduler._arm_probe()
+        time.sleep(0.02)
+        timers.advance()
+        self.assertEqual(sent, {'A': [10], 'B': [20]})
+
+    def test_bus_owns(self):
+        buses = [multi_serial_port.Bus(domusim.DomuinoBus({}), None) for _ in range(2)]
+        routes = multi_serial_port.RoutingTable(buses)
+        for bus in buses:
+            bus.routes = routes
+        routes.learn(10, buses[1])
+        self.assertEqual([bus.owns(10) for bus in buses], [False, True])
+
+
+class TestCoalesce(unittest.TestCase):
+    def setUp(self):
+        self.sent = []
+        self.scheduler = PacketScheduler(TimerWheel(), lambda p, again: self.sent.append((p.dest, bytes(p.data), again)),
+                                         coalesce=multi_serial_port.coalesce_key, cost=0.01)
+
+    @staticmethod
+    def packet(data, dest=10):
+        return multi_serial_port.Packet(bytes(data), dest=dest)
+
+    def press(self, name, switch):
+        state = [0] * 6
+        state[switch - 1] = 1
+        net = multi_serial_port.config[name]['net']
+        self.scheduler.extend(multi_serial_port.execute({'node': net, 'msg': "SWITCH", 'state': state},
+                                                        multi_serial_port.config))
+
+    def test_light_toggles(self):
+        # ms-config.yaml: every switch toggles one output of LIGHT1 with the same frame on each press
+        self.press("CU-1M", 1)
+        self.scheduler.pump()
+        for name, switch in (("CU-1M", 2), ("CM-1M", 1), ("C2-3M", 1), ("CU-1M", 1)):
+            self.press(name, switch)
+        self.assertEqual(len(self.scheduler), 5)
+        while self.scheduler.inflight:
+            self.scheduler.acknowledge(100, 0xA4)
+            self.scheduler.pump()
+        self.assertEqual(len(self.sent), 5)
+        self.assertEqual(self.sent[0], self.sent[-1])
+        self.assertFalse(self.scheduler.counters)
+
+    def test_lcdprint(self):
+        self.scheduler.submit(self.packet([0xA0]))
+        self.scheduler.pump()
+        self.scheduler.extend([self.packet([0x92, 5, 2, 1, ord("1")]), self.packet([0x92, 5, 72, 1, ord("5")]),
+                               self.packet([0x92, 5, 2, 1, ord("2")])])
+        self.assertEqual([p.data[4] for _, p in self.scheduler.pending[10]], [ord("2"), ord("5")])
+
+    def test_duplicates(self):
+        self.scheduler.submit(self.packet([0x90]))
+        self.scheduler.pump()
+        # The one in flight could still expire
+        self.scheduler.extend([self.packet([0x90]), self.packet([0x92, 5, 2, 1, ord("1")]), self.packet([0x90]),
+                               self.packet([0x92, 5, 2, 1, ord("1")])])
+        self.assertEqual(len(self.scheduler), 3)
+        self.assertEqual(dict(self.scheduler.counters), {'duplicates': 2})
+        self.assertAlmostEqual(self.scheduler.saved, 0.02)
+
+    def test_barrier(self):
+        self.scheduler.extend([self.packet([0x92, 0, 0, 0, ord("a")]), self.packet([0x91]),
+                               self.packet([0x92, 0, 0, 0, ord("b")]), self.packet([0x81], dest=255)])
+        self.assertEqual(len(self.scheduler), 4)
+        self.assertFalse(self.scheduler.counters)
+
+
+class TestCRC(unittest.TestCase):
+    def test_modbus(self):
+        self.assertEqual(crc16.crc16(b'123456789'), 0x4B37)
+        self.assertEqual(crc16.crc16_bytes(b'123456789'), b'\x37\x4b')
+
+    @unittest.skipUnless(importlib.util.find_spec("crcmod"), "crcmod not installed")
+    def test_crcmod(self):
+        from crcmod.crcmod import _usingExtension
+        self.assertEqual(crc16.ACCELERATED, _usingExtension)
+        frame = multi_serial_port.Packet(b'\x92\x05\x02\x01', dest=10).serialize()
+        for data in (b'123456789', frame[:-2], frame, b''):
+            self.assertEqual(crc16.crc16(data), crc16.crc16_table(data))
+
+
+class TestFrameDecoder(unittest.TestCase):
+    def setUp(self):
+        self.decoder = FrameDecoder(multi_serial_port.PACKET_HEADER, multi_serial_port.MAX_PACKET_SIZE,
+                                    check=multi_serial_port.valid_frame)
+        self.frame = multi_serial_port.Packet(b'\xa3\x01', source=11, dest=1).serialize()
+
+    def decode(self, data):
+        return [bytes(f) for f in self.decoder.decode(data)]
+
+    def test_split_frame(self):
+        self.assertEqual(self.decode(self.frame[:7]), [])
+        self.assertEqual(self.decode(self.frame[7:]), [self.frame[2:]])
+
+    def test_resync_on_garbage(self):
+        garbage = b'\x01' + multi_serial_port.PACKET_HEADER + b'\x02' * 5
+        self.assertEqual(self.decode(garbage + self.frame + self.frame[:-1] + b'\x00' + self.frame),
+                         [self.frame[2:], self.frame[2:]])
+
+    def test_many_frames(self):
+        frames = self.frame * 40
+        result = []
+        for i in range(0, len(frames), 13):
+            result.extend(self.decode(frames[i:i + 13]))
+        self.assertEqual(len(result), 40)
+
+    def test_check_msg(self):
+        received = multi_serial_port.check_msg(next(self.decoder.decode(self.frame)), verified=True)
+        self.assertEqual((received.source, received.dest, received.data[:2]), (11, 1, b'\xa3\x01'))
+
+
+class TestBusSimulator(unittest.TestCase):
+    def run_bus(self, sim, seconds=0.5):
+        bus = multi_serial_port.Bus(sim, lambda packets: bus.submit(packets))
+        bus.start()
+        time.sleep(seconds)
+        bus.stop()
+        bus.join()
+        return sim.stats()
+
+    def test_ack(self):
+        stats = self.run_bus(domusim.DomuinoBus({10: {'HBT': 20}, 11: {'MEM': 20}}, seed=0))
+        self.assertGreater(stats['acked'], 5)
+        self.assertEqual(stats.get('lost', 0), 0)
+        # From the end of the node frame to the end of the ACK (21 bytes at 38400 baud)
+        self.assertGreater(stats['p50'], 21 * 10 / 38400)
+
+    def test_corrupt(self):
+        stats = self.run_bus(domusim.DomuinoBus({10: {'HBT': 20}}, corrupt=1.0, seed=0), seconds=0.3)
+        self.assertGreater(stats['sent'], 0)
+        self.assertNotIn('acked', stats)
+
+    def test_collision(self):
+        sim = domusim.DomuinoBus({10: {}}, seed=0)
+        sim._emit(time.monotonic(), 10, b'\x9f')
+        # The hub doesn't wait for the node frame on the line: both are garbled
+        sim.write(multi_serial_port.Packet(b'\x90', dest=10).serialize())
+        self.assertEqual((sim.counters['collisions'], sim.counters['hub collisions']), (1, 1))
+        self.assertEqual((len(sim.output), sim.counters['commands']), (0, 0))
+        # A node waits for the end of the hub frame
+        sim.write(multi_serial_port.Packet(b'\x90', dest=10).serialize())
+        self.assertGreaterEqual(sim._emit(time.monotonic(), 10, b'\x9f'), sim.hub_free)
+        self.assertEqual(sim.counters['commands'], 1)
+
+    def test_program_own_bus(self):
+        sims = [domusim.DomuinoBus({}, seed=0), domusim.DomuinoBus({}, seed=0)]
+        buses = [multi_serial_port.Bus(sim, lambda packets: None) for sim in sims]
+        with mock.patch.object(multi_serial_port, "SimpleDude") as dude:
+            dude.return_value.wait_bootloader.return_value = True
+            sims[1]._emit(time.monotonic(), 11, bytes([multi_serial_port.QUERIES["PROGRAM"]]))
+            for bus in buses:
+                bus.start()
+            time.sleep(0.1)
+            for bus in buses:
+                bus.stop()
+                bus.join()
+        self.assertIs(dude.call_args[0][0], sims[1])
+        dude.return_value.program.assert_called_once_with()
+
+    def test_bus_error(self):
+        class Broken(domusim.DomuinoBus):
+            def write(self, data):
+                raise OSError("port gone")
+
+        failed = threading.Event()
+        bus = multi_serial_port.Bus(Broken({}), lambda packets: None, failed=failed)
+        bus.submit(multi_serial_port.prepare_commands(11, "MEM", multi_serial_port.config))
+        with self.assertLogs("multi_serial_port", "ERROR"):
+            bus.start()
+            self.assertTrue(failed.wait(1))
+            bus.join(1)
+        self.assertFalse(bus.is_alive())
+        self.assertIsInstance(bus.error, OSError)
+
+    def test_answer(self):
+        sim = domusim.DomuinoBus({11: {}}, seed=0)
+        bus = multi_serial_port.Bus(sim, lambda packets: None)
+        bus.submit(multi_serial_port.prepare_commands(11, "MEM", multi_serial_port.config))
+        bus.start()
+        time.sleep(0.2)
+        bus.stop()
+        bus.join()
+        self.assertEqual(sim.counters['answers'], 1)
+        self.assertEqual(len(bus.scheduler), 0)
+
+
+class TestEventLog(unittest.TestCase):
+    def setUp(self):
+        self.logger = logging.getLogger("eventlog-test")
+        self.logger.setLevel(logging.WARNING)
+
+    def test_disabled(self):
+        events = eventlog.EventLog(self.logger)
+        events.log(logging.INFO, "HUB->", "bus", 11, 0xA4)
+        self.assertIsNone(events.thread)
+        self.assertTrue(events.queue.empty())
+
+    def test_sink(self):
+        fd, path = tempfile.mkstemp(suffix=".jsonl")
+        os.close(fd)
+        try:
+            events = eventlog.EventLog(self.logger, names=multi_serial_port.QUERIES, sink=eventlog.JsonlSink(path))
+            events.log(logging.DEBUG, "HUB[+1]->", "bus", 11, 0xA4, b'\x01\x00')
+            events.log(logging.INFO, "->HUB", None, 12, 0xA0, {'temperature': 21.5})
+            events.stop()
+            events.sink.close()
+            with open(path) as f:
+                lines = [json.loads(line) for line in f]
+        finally:
+            os.remove(path)
+        self.assertEqual([(e['type'], e['node'], e['msg'], e['data']) for e in lines],
+                         [("HUB[+1]->", 11, "LIGHT", "0100"), ("->HUB", 12, "DHT", {'temperature': 21.5})])
+        self.assertLessEqual(lines[0]['t'], lines[1]['t'])
+
+    def test_format(self):
+        events = eventlog.EventLog(self.logger, names=multi_serial_port.QUERIES)
+        line = events.format((0.0, logging.INFO, "HUB->", "bus", 11, 0xA4, b'\x01'))
+        self.assertTrue(line.endswith("HUB-> LIGHT node 11 bus bus 01"))
+
+
+class TestSensorStore(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = sensorstore.SensorStore(self.root, segment=sensorstore.HOUR)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.root)
+
+    def test_range(self):
+        for i in range(200):
+            self.store.add(12, 'temperature', 20 + i % 10, t=3000 + i * 5)
+        self.store.add(12, 'humidity', 50.0, t=3000)
+        self.store.flush()
+        # 3000..3995 spans two hourly segments
+        self.assertEqual(len(os.listdir(os.path.join(self.root, "12"))), 3)
+        values = self.store.query(12, 'temperature', 3590, 3615)
+        self.assertEqual([t for t, _ in values], [3590, 3595, 3600, 3605, 3610])
+        self.assertEqual(self.store.query(12, 'temperature', 0, 100), [])
+        self.assertEqual(self.store.metrics(12), ['humidity', 'temperature'])
+
+    def test_rollup(self):
+        for i in range(120):
+            self.store.add(13, 'mem', i, t=7200 + i)
+        self.store.flush()
+        self.assertEqual(self.store.rollup(13, 'mem', 0, 10000),
+                         [(7200, 0, 59, 29.5, 60), (7260, 60, 119, 89.5, 60)])
+        self.assertEqual(self.store.rollup(13, 'mem', 0, 10000, period=sensorstore.HOUR), [(7200, 0, 119, 59.5, 120)])
+
+    def test_parse_packet(self):
+        multi_serial_port.STORE = self.store
+        try:
+            packet = multi_serial_port.Packet(bytes([multi_serial_port.QUERIES['DHT'], 215, 0, 0xF4, 1]), source=12)
+            multi_serial_port.parse_packet(packet)
+        finally:
+            multi_serial_port.STORE = None
+        self.store.flush()
+        self.assertEqual([v for _, v in self.store.query(12, 'temperature', 0, 1e10)], [21.5])
+        self.assertEqual([v for _, v in self.store.query(12, 'humidity', 0, 1e10)], [50.0])
+
+    def test_domuino_parse_query(self):
+        # The module must import without mm485, the DomuNet bus thread
+        import domuino
+        self.assertIs(domuino.SENSORS, multi_serial_port.SENSORS)
+        node = domuino.Domuino()
+        node.lock, node.logger, node.logextra = threading.Lock(), logging.getLogger("domuino"), {'node': 12}
+        node.store = self.store
+        packet = types.SimpleNamespace(data=bytes([domuino.QUERIES['DHT'], 215, 0, 0xF4, 1]), source=12)
+        self.assertEqual(node.parse_query(packet), bytes([domuino.QUERIES['ACK']]))
+        self.store.flush()
+        self.assertEqual([v for _, v in self.store.query(12, 'temperature', 0, 1e10)], [21.5])
+
+
+class TestNodeState(unittest.TestCase):
+    def test_parse_packet(self):
+        multi_serial_port.parse_packet(multi_serial_port.Packet(bytes([0xA3, 0, 1, 0, 0, 0, 0]), source=11))
+        multi_serial_port.parse_packet(multi_serial_port.Packet(bytes([0x9F]), source=11))
+        node = multi_serial_port.NODES[11]
+        self.assertEqual(node.switch, [0, 1, 0, 0, 0, 0])
+        self.assertIsNotNone(node.last_heartbeat)
+        self.assertEqual(multi_serial_port.NODES.node(11)['name'], "C2-3M")
+
+    def test_replace(self):
+        table = nodestate.NodeTable()
+        table.update(20, {'msg': "DHT", 'temperature': 21.5, 'humidity': 40.0}, now=1.0)
+        updated = table[20].updated
+        table.update(20, {'msg': "MEM", 'value': 512}, now=2.0)
+        # Readers holding the old values still see them whole
+        self.assertEqual(updated, {'temperature': 1.0, 'humidity': 1.0})
+        self.assertEqual(table.node(20)['updated'], {'temperature': 1.0, 'humidity': 1.0, 'mem': 2.0})
+        self.assertEqual((table[20].temperature, table[20].mem, table[20].last_seen), (21.5, 512, 2.0))
+
+    def test_http(self):
+        table = nodestate.NodeTable({30: "BP-1M"})
+        table.update(30, {'msg': "VERSION", 'version': 7})
+        server = nodestate.StateServer(table, port=0)
+        server.start()
+        try:
+            url = f"http://127.0.0.1:{server.port}/nodes"
+            with urllib.request.urlopen(url) as reply:
+                self.assertEqual(json.load(reply)["30"]['version'], 7)
+            with urllib.request.urlopen(url + "/30") as reply:
+                self.assertEqual(json.load(reply)['name'], "BP-1M")
+            with self.assertRaises(urllib.error.HTTPError):
+                urllib.request.urlopen(url + "/31")
+        finally:
+            server.stop()
+
+
 if __name__ == '__main__':
     unittest.main()
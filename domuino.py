@@ -12,8 +12,14 @@ import datetime
 import struct
 import logging
 
-from simpledude import SimpleDude
-from mm485 import DomuNet
+from simpledude import SimpleDude, BAUD_RATE, FLASH_MANIFEST, record_boot_baudrate
+from sensorstore import SensorStore, SENSORS
+from nodestate import NodeTable, StateServer, HTTP_PORT
+try:
+    from mm485 import DomuNet
+except ImportError:
+    # The DomuNet bus thread is a separate package: without it only the module helpers are usable
+    DomuNet = object
 
 import yaml
 from nbstreamreader import NonBlockingStreamReader as NBSR, UnexpectedEndOfStream
@@ -159,6 +165,11 @@ QUERIES = {
 
 
 class Domuino(DomuNet):
+    # SensorStore for the values reported by the nodes
+    store = None
+    # NodeTable with the last state of the nodes
+    nodes = None
+
     def parse_query(self, packet):
         try:
             if packet.data[0] not in QUERIES:
@@ -178,9 +189,11 @@ class Domuino(DomuNet):
                 elif packet.data[0] == QUERIES['EMS']:  # ems
                     value.update({'value': struct.unpack("ff", packet.data[1:8])})
                 elif packet.data[0] == QUERIES['DHT']:  # TEMP & HUM
-                    # value.update({'temperature': struct.unpack("h", packet.data[1:3])[0] / 10.0,
-                    #               'humidity': struct.unpack("h", packet.data[3:5])[0] / 10.0})
-                    pass
+                    value.update({'temperature': struct.unpack("h", packet.data[1:3])[0] / 10.0,
+                                  'humidity': struct.unpack("h", packet.data[3:5])[0] / 10.0})
+                elif packet.data[0] == QUERIES['LCDINIT']:
+                    # Nodes don't send LCD commands: 0x94 from a node is the VERSION of the current firmware
+                    value.update({'msg': "VERSION", 'version': struct.unpack("h", packet.data[1:3])[0]})
                 elif packet.data[0] == QUERIES['PIR']:
                     value.update({'value': struct.unpack("b", packet.data[1:2])[0]})
                 elif packet.data[0] == QUERIES['LUX']:
@@ -192,6 +205,11 @@ class Domuino(DomuNet):
                        self.send(4, bytearray((QUERIES["LIGHT"], state[0], 0, 0)))
                 elif packet.data[0] == QUERIES["HBT"]:
                     pass
+            if self.nodes is not None:
+                self.nodes.update(packet.source, value)
+            if self.store is not None:
+                for field, metric in SENSORS.get(value['msg'], ()):
+                    self.store.add(packet.source, metric, value[field])
             self.logger.info(value, extra=self.logextra)
         except Exception as e:
             raise Exception('{}'.format(value))
@@ -217,10 +235,13 @@ class Domuino(DomuNet):
             elif packet.data[0] == QUERIES["PROGRAM"]:
                 dude = SimpleDude(self.port,
                                   hexfile=self.hexfile,
-                                  mode485=True)
+                                  mode485=True,
+                                  manifest=FLASH_MANIFEST)
                 dude.logger = self.logger
-                time.sleep(1)
-                dude.program()
+                if dude.wait_bootloader():
+                    dude.program()
+                else:
+                    self.logger.error("Bootloader not answering", extra=self.logextra)
                 pass
             # if packet.data[0] == PARAMETERS['PONG']:
             #     print("PONG")
@@ -246,17 +267,23 @@ class Domuino(DomuNet):
                 print(output.decode("UTF-8"), end="")
             if error:
                 print(error.decode("UTF-8"), end="")
+        return p.returncode
 
-    def compile_bootloader(self, make, env, address, workdir):
+    def compile_bootloader(self, make, env, address, workdir, baudrate=BAUD_RATE, compression=False):
         make = "{} " \
-               "ENV={} BAUD_RATE=38400 LED=D2 LED_START_FLASHES=5 " \
-               "SN_MAJOR={} SN_MINOR={} pro8".format(make, env, address // 0xff, address % 0xff)
+               "ENV={} BAUD_RATE={} LED=D2 LED_START_FLASHES=5 COMPRESSION={} " \
+               "SN_MAJOR={} SN_MINOR={} pro8".format(make, env, baudrate, int(compression),
+                                                     address // 0xff, address % 0xff)
         #        cp_command = "cp" if os.name == "posix" else "copy"
         #        cp = "{} {} {}".format(cp_command, source, destination)
         self._run("{}".format(make), work_dir=workdir)
 
-    def flash_bootloader(self, bootloader):
-        self._run(AVRCMD + " -u -U flash:w:\"{}\":i -vv".format(bootloader))
+    def flash_bootloader(self, bootloader, address=None, baudrate=BAUD_RATE):
+        """ Write the bootloader built for node address, its rate is recorded once it is in flash"""
+        if self._run(AVRCMD + " -u -U flash:w:\"{}\":i -vv".format(bootloader)):
+            self.logger.error("Bootloader not flashed", extra=self.logextra)
+        elif address is not None:
+            record_boot_baudrate(address, baudrate)
 
     def update_fuses(self, low=0xDE, high=0xDC, extend=0xFA):
         self._run(AVRCMD + " -U lfuse:w:{}:m -U hfuse:w:{}:m -U efuse:w:{}:m".format(low, high, extend))
@@ -328,9 +355,15 @@ if __name__ == '__main__':
     parser.add_argument("--light", help="Set light [1=ON/0=OFF]")
     parser.add_argument("-E", "--env", help="Environment to build optiboot: (sloeber, sloeberwin, etc..)")
     parser.add_argument("-W", "--workdir", help="Working directory")
+    parser.add_argument("-B", "--bootbaud", type=int, default=BAUD_RATE, help="Baud rate of the bootloader to make or flash")
+    parser.add_argument("-Z", "--compression", action="store_true", help="Make bootloader with compressed pages")
     parser.add_argument("-F", "--fuses", help="Update fuses")
     parser.add_argument("-S", "--setstate", help="Update device state. valid value = [RUN|STANDBY]")
+    parser.add_argument("--store", help="Directory of the sensor store")
+    parser.add_argument("--http", type=int, nargs="?", const=HTTP_PORT, help="Serve the node states on localhost")
     args = parser.parse_args()
+    if DomuNet is object:
+        parser.error("mm485 is not installed")
 
     # ser = serial_for_url('/dev/ttyUSB0', rtscts=True, baudrate=38400)
     ser = serial_for_url(args.port, baudrate=38400, timeout=0.1) if args.port else None
@@ -338,6 +371,11 @@ if __name__ == '__main__':
 
     a = Domuino(1, ser)
     a.daemon = True
+    if args.store:
+        a.store = SensorStore(args.store)
+    if args.http:
+        a.nodes = NodeTable()
+        StateServer(a.nodes, port=args.http).start()
     try:
         if args.info:
             # a.start()
@@ -349,20 +387,21 @@ if __name__ == '__main__':
         elif args.loop:
             domuino_communicate(a)
         elif args.make:
-            a.compile_bootloader(args.make, args.env, args.id, args.workdir)
+            a.compile_bootloader(args.make, args.env, args.id, args.workdir, args.bootbaud, args.compression)
         elif args.update:
             a.hexfile = args.update
             domuino_communicate(a, {args.id: "PROGRAM"})
         elif args.flash:
             dude = SimpleDude(ser,
                               hexfile=args.flash,
-                              mode485=True)
+                              mode485=True,
+                              manifest=FLASH_MANIFEST)
             dude.program()
         elif args.fuses:
             low, high, extend = map(lambda l: int(l, 16), args.fuses.split())
             a.update_fuses(low, high, extend)
         elif args.boot:
-            a.flash_bootloader(args.boot)
+            a.flash_bootloader(args.boot, args.id, args.bootbaud)
         elif args.address:
             domuino_communicate(a, {args.id: {"SETID": [args.address % 0xff, args.address // 0xff]}})
         elif args.config:
@@ -0,0 +1,288 @@
+""" Virtual Domuino nodes on a simulated RS485 bus, to load the hub without hardware.
+
+DomuinoBus is a serial port look-alike: every node of ms-config.yaml sends HBT, PIR and MEM frames,
+plus SWITCH and DHT when it has rules for them, at the configured rates (Poisson arrivals). A node
+waits for the hub ACK before sending the next frame and answers the packets of the hub after the
+ACK latency. A fraction of the frames can be dropped or corrupted in both directions. The bus is half duplex: with throttle=True every
+frame keeps the line busy for its time at the port baudrate. A node waits for the line to be quiet before
+sending, the hub writes as soon as it has something to send: a hub frame starting over a node frame garbles both.
+
+Give the bus straight to multi_serial_port.Bus, or serve it on a pty (stk500sim.PtyServer) for a
+hub opening the port by name. Run the module to find the saturation point of the hub:
+
+    python domusim.py -f 20 50 100 200 -d 5
+"""
+import time
+import heapq
+import random
+import struct
+import logging
+import argparse
+from collections import Counter, deque
+
+from framing import FrameDecoder
+from multi_serial_port import (Packet, QUERIES, PACKET_HEADER, MAX_PACKET_SIZE, NODE_ID, BROADCAST, valid_frame,
+                               config)
+
+LOGGER = logging.getLogger(__name__)
+
+# Frames per second of every node
+RATES = {'HBT': 0.2, 'SWITCH': 0.05, 'DHT': 0.02, 'PIR': 0.05, 'MEM': 0.01}
+ACK_LATENCY = (0.001, 0.003)  # s, range of the node processing time before an answer
+NODE_TIMEOUT = 0.5  # s, a node gives up waiting the ACK of its frame
+
+
+def payload(msg, rng):
+    """ Data of a node frame with plausible values"""
+    code = bytes([QUERIES[msg]])
+    if msg == "SWITCH":
+        return code + bytes(rng.randint(0, 1) for _ in range(6))
+    if msg == "DHT":
+        return code + struct.pack("hh", rng.randint(150, 300), rng.randint(300, 800))
+    if msg == "PIR":
+        return code + struct.pack("b", rng.randint(0, 1))
+    if msg == "MEM":
+        return code + struct.pack("h", rng.randint(200, 900))
+    return code
+
+
+def config_nodes(config, rates=RATES):
+    """ {net: {message: frames per second}} of the configured nodes"""
+    nodes = dict()
+    for settings in config.values():
+        if settings['net'] != BROADCAST:
+            nodes[settings['net']] = {msg: rate for msg, rate in rates.items()
+                                      if msg not in ("SWITCH", "DHT") or msg in settings}
+    return nodes
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class DomuinoBus(object):
+    """ The nodes {net: {message: frames per second}} on one bus, with the pyserial calls used by the hub"""
+
+    def __init__(self, nodes, ack_latency=ACK_LATENCY, drop=0.0, corrupt=0.0, throttle=True, baudrate=38400,
+                 seed=None):
+        self.nodes = nodes
+        self.nets = set(nodes)
+        self.ack_latency = ack_latency
+        self.drop = drop
+        self.corrupt = corrupt
+        self.throttle = throttle
+        self.baudrate = baudrate
+        self.timeout = 0.5
+        self.name = "domusim"
+        self.random = random.Random(seed)
+        self.decoder = FrameDecoder(PACKET_HEADER, MAX_PACKET_SIZE, check=valid_frame)
+        # Bytes on their way to the hub: [time they are readable, bytes]
+        self.output = deque()
+        # End of the last frame on the line, and of the last hub frame
+        self.line_free = 0.0
+        self.hub_free = 0.0
+        # Node frames on the line: (start, end, their output entry or None when lost anyway)
+        self.on_line = deque()
+        # Node events: (time, sequence, net, message name or None for an answer, data)
+        self.events = list()
+        self.sequence = 0
+        # net: (time the frame left the line, message) of the frames waiting for the ACK
+        self.waiting = dict()
+        self.latencies = list()
+        self.counters = Counter()
+        self.start = time.monotonic()
+        for net, rates in nodes.items():
+            for msg, rate in rates.items():
+                if rate:
+                    self._schedule(self.start + self.random.expovariate(rate), net, msg)
+
+    def _schedule(self, due, net, msg, data=None):
+        self.sequence += 1
+        heapq.heappush(self.events, (due, self.sequence, net, msg, data))
+
+    def _frame_time(self, size):
+        return size * 10 / self.baudrate if self.throttle else 0.0
+
+    def _emit(self, due, net, data):
+        """ A node sends data to the hub, return the time the frame has been received"""
+        frame = bytearray(Packet(data, source=net, dest=NODE_ID).serialize())
+        start = max(due, self.line_free)
+        end = self.line_free = start + self._frame_time(len(frame))
+        entry = None
+        if self.random.random() < self.drop:
+            self.counters['dropped'] += 1
+        else:
+            if self.random.random() < self.corrupt:
+                frame[self.random.randrange(len(frame))] ^= 1 << self.random.randrange(8)
+                self.counters['corrupted'] += 1
+            entry = [end, bytes(frame)]
+            self.output.append(entry)
+        if end > start:
+            self.on_line.append((start, end, entry))
+        return end
+
+    def _collide(self, start, end):
+        """ True when a node frame is on the line between start and end, the node frames hit are lost too"""
+        while self.on_line and self.on_line[0][1] <= start:
+            self.on_line.popleft()
+        hit = False
+        for frame_start, frame_end, entry in self.on_line:
+            if frame_start < end and start < frame_end:
+                hit = True
+                if entry is not None and entry in self.output:
+                    self.output.remove(entry)
+                    self.counters['collisions'] += 1
+        return hit
+
+    def advance(self, now):
+        """ Run the node events due by now"""
+        while self.events and self.events[0][0] <= now:
+            due, _, net, msg, data = heapq.heappop(self.events)
+            if msg is None:
+                self._emit(due, net, data)
+                self.counters['answers'] += 1
+                continue
+            if net in self.waiting:
+                sent, _ = self.waiting[net]
+                if due < sent + NODE_TIMEOUT:
+                    # Still waiting the ACK of the previous frame
+                    self._schedule(sent + NODE_TIMEOUT, net, msg)
+                    continue
+                del self.waiting[net]
+                self.counters['lost'] += 1
+            self.waiting[net] = (self._emit(due, net, payload(msg, self.random)), msg)
+            self.counters['sent'] += 1
+            self.counters[msg] += 1
+            self._schedule(due + self.random.expovariate(self.nodes[net][msg]), net, msg)
+
+    def received(self, packet, now):
+        """ A frame of the hub reached the nodes"""
+        if packet.data[0] == QUERIES['ACK']:
+            if packet.dest in self.waiting:
+                sent, _ = self.waiting.pop(packet.dest)
+                self.latencies.append(now - sent)
+                self.counters['acked'] += 1
+            return
+        self.counters['commands'] += 1
+        for net in (self.nets if packet.dest == BROADCAST else self.nets & {packet.dest}):
+            # The node answers with the same command
+            self._schedule(now + self.random.uniform(*self.ack_latency), net, None, packet.data[:1])
+
+    # Serial port interface
+    def write(self, data):
+        start = max(time.monotonic(), self.hub_free)
+        end = self.hub_free = start + self._frame_time(len(data))
+        # The node frames started before this one are on the line, the later ones wait for its end
+        self.advance(start)
+        self.line_free = max(self.line_free, end)
+        if self._collide(start, end):
+            self.counters['hub collisions'] += 1
+            return len(data)
+        if self.random.random() < self.drop:
+            self.counters['hub dropped'] += 1
+            return len(data)
+        for body in self.decoder.decode(data):
+            self.received(Packet.from_buffer(body), end)
+        return len(data)
+
+    def _available(self, now):
+        self.advance(now)
+        count = 0
+        for ready, frame in self.output:
+            if ready > now:
+                break
+            count += len(frame)
+        return count
+
+    @property
+    def in_waiting(self):
+        return self._available(time.monotonic())
+
+    def read(self, size=1):
+        data = bytearray()
+        while self.output and len(data) < size and self.output[0][0] <= time.monotonic():
+            ready, frame = self.output.popleft()
+            taken = frame[:size - len(data)]
+            data += taken
+            if len(taken) < len(frame):
+                self.output.appendleft([ready, frame[len(taken):]])
+        return bytes(data)
+
+    def readinto(self, buffer):
+        data = self.read(min(len(buffer), self.in_waiting))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def reset_input_buffer(self):
+        self.read(self.in_waiting)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def stats(self):
+        elapsed = time.monotonic() - self.start
+        stats = dict(self.counters)
+        stats.update({'seconds': elapsed,
+                      'offered fps': self.counters['sent'] / elapsed,
+                      'acked fps': self.counters['acked'] / elapsed,
+                      'p50': percentile(self.latencies, 0.5),
+                      'p90': percentile(self.latencies, 0.9),
+                      'p99': percentile(self.latencies, 0.99)})
+        return stats
+
+
+def saturate(fps, duration=5.0, drop=0.0, corrupt=0.0, use_pty=False, window=None, seed=None):
+    """ Run a hub Bus against the nodes of ms-config.yaml sending fps frames per second in total"""
+    import serial
+    import multi_serial_port
+    from stk500sim import PtyServer
+
+    nodes = config_nodes(config)
+    # Keep the mix of messages, scaled to fps in total
+    scale = fps / sum(sum(rates.values()) for rates in nodes.values())
+    nodes = {net: {msg: rate * scale for msg, rate in rates.items()} for net, rates in nodes.items()}
+    sim = DomuinoBus(nodes, drop=drop, corrupt=corrupt, seed=seed)
+    server = None
+    port = sim
+    if use_pty:
+        server = PtyServer(sim)
+        server.start()
+        port = serial.Serial(server.port, baudrate=sim.baudrate, timeout=0.5)
+    bus = multi_serial_port.Bus(port, lambda packets: bus.submit(packets),
+                                window=window or multi_serial_port.BUS_WINDOW)
+    sim.start = time.monotonic()
+    bus.start()
+    time.sleep(duration)
+    bus.stop()
+    bus.join()
+    if server:
+        port.close()
+        server.stop()
+    return sim.stats()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load the hub with simulated Domuino nodes")
+    parser.add_argument("-f", "--fps", type=float, nargs="+", default=[10, 50, 100, 200],
+                        help="Frames per second sent by all the nodes together")
+    parser.add_argument("-d", "--duration", type=float, default=5.0, help="Seconds of every step")
+    parser.add_argument("--drop", type=float, default=0.0, help="Fraction of frames lost")
+    parser.add_argument("--corrupt", type=float, default=0.0, help="Fraction of frames with a bit flipped")
+    parser.add_argument("--pty", action="store_true", help="Go through a pseudo terminal")
+    args = parser.parse_args()
+
+    logging.getLogger("multi_serial_port").setLevel(logging.WARNING)
+    print(f"{'offered':>8} {'sent/s':>8} {'acked/s':>8} {'lost':>6} {'collide':>7} {'p50 ms':>7} {'p90 ms':>7} "
+          f"{'p99 ms':>7}")
+    for fps in args.fps:
+        stats = saturate(fps, args.duration, args.drop, args.corrupt, args.pty, seed=0)
+        p50, p90, p99 = (f"{stats[p] * 1000:7.1f}" if stats[p] is not None else f"{'-':>7}"
+                         for p in ('p50', 'p90', 'p99'))
+        print(f"{fps:>8} {stats['offered fps']:>8.1f} {stats['acked fps']:>8.1f} {stats.get('lost', 0):>6} "
+              f"{stats.get('hub collisions', 0):>7} {p50} {p90} {p99}")
@@ -0,0 +1,124 @@
+""" Low overhead event log of the hub.
+
+The bus threads put events on a queue as tuples (monotonic time, level, type, bus, node, msg, data):
+a background thread turns them into log lines and writes them to the optional JSONL sink.
+Check enabled(level) before building the arguments of an event, so disabled events cost nothing.
+"""
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+
+# time.time() when time.monotonic() was 0: events keep the monotonic time, the wall clock is only for printing
+WALL_OFFSET = time.time() - time.monotonic()
+
+
+def _default(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value).hex()
+    return str(value)
+
+
+class JsonlSink(object):
+    """ One json object per line, for later analysis"""
+
+    def __init__(self, path):
+        self.file = open(path, "a")
+
+    def write(self, event, names):
+        t, level, kind, bus, node, msg, data = event
+        self.file.write(json.dumps({'t': round(t + WALL_OFFSET, 6),
+                                    'level': logging.getLevelName(level),
+                                    'type': kind,
+                                    'bus': bus,
+                                    'node': node,
+                                    'msg': names.get(msg, msg),
+                                    'data': data}, default=_default) + "\n")
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class EventLog(object):
+    """ Events for logger, formatted and written in a worker thread started by the first event.
+
+    names maps the message codes to their names. The sink, when given, receives the events of
+    sink_level and above even if the logger filters them out.
+    """
+
+    def __init__(self, logger, names=None, sink=None, sink_level=logging.DEBUG):
+        self.logger = logger
+        self.names = names or dict()
+        self.sink = sink
+        self.sink_level = sink_level
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def enabled(self, level):
+        return self.logger.isEnabledFor(level) or (self.sink is not None and level >= self.sink_level)
+
+    def log(self, level, kind, bus, node, msg, data=None):
+        if not self.enabled(level):
+            return
+        self.queue.put((time.monotonic(), level, kind, bus, node, msg, data))
+        if self.thread is None:
+            self._start()
+
+    def set_sink(self, sink, sink_level=logging.DEBUG):
+        self.sink_level = sink_level
+        self.sink = sink
+
+    def _start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="EventLog", daemon=True)
+                self.thread.start()
+                atexit.register(self.stop)
+
+    def stop(self, timeout=1.0):
+        """ Write the queued events and stop the worker"""
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join(timeout)
+            self.thread = None
+            atexit.unregister(self.stop)
+        if self.sink is not None:
+            self.sink.flush()
+
+    def format(self, event):
+        t, level, kind, bus, node, msg, data = event
+        wall = time.strftime("%d/%m/%Y %H:%M:%S", time.localtime(t + WALL_OFFSET))
+        line = f"{wall} {kind} {self.names.get(msg, msg)} node {node}"
+        if bus is not None:
+            line += f" bus {bus}"
+        if data:
+            line += f" {bytes(data).hex() if isinstance(data, (bytes, bytearray, memoryview)) else data}"
+        return line
+
+    def _run(self):
+        while True:
+            events = [self.queue.get()]
+            # Take the whole backlog, the sink is flushed once per batch
+            try:
+                while True:
+                    events.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            for event in events:
+                if event is None:
+                    if self.sink is not None:
+                        self.sink.flush()
+                    return
+                level = event[1]
+                if self.logger.isEnabledFor(level):
+                    self.logger.log(level, self.format(event))
+                if self.sink is not None and level >= self.sink_level:
+                    self.sink.write(event, self.names)
+            if self.sink is not None:
+                self.sink.flush()
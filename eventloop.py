@@ -0,0 +1,122 @@
+import os
+import time
+import selectors
+import logging
+
+LOGGER = logging.getLogger(__name__)
+
+# Used when a port cannot be registered in the selector (e.g. loop:// urls or Windows COM ports)
+POLL_INTERVAL = 0.002
+
+
+class Timer(object):
+    __slots__ = ('deadline', 'rounds', 'callback', 'args', 'cancelled')
+
+    def __init__(self, deadline, rounds, callback, args):
+        self.deadline = deadline
+        self.rounds = rounds
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerWheel(object):
+    """ Hashed timing wheel: O(1) schedule/cancel, expiry checked one tick at a time"""
+
+    def __init__(self, tick=0.005, slots=256):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.current = 0
+        self.last = time.monotonic()
+        self.pending = 0
+
+    def schedule(self, delay, callback, *args):
+        ticks = max(1, int(delay / self.tick + 0.5))
+        rounds, offset = divmod(ticks, len(self.slots))
+        if offset == 0:
+            rounds, offset = rounds - 1, len(self.slots)
+        timer = Timer(time.monotonic() + delay, rounds, callback, args)
+        self.slots[(self.current + offset) % len(self.slots)].append(timer)
+        self.pending += 1
+        return timer
+
+    def timeout(self):
+        """ Seconds until the next tick holding a timer, None if the wheel is empty"""
+        if not self.pending:
+            return None
+        for i in range(1, len(self.slots) + 1):
+            for timer in self.slots[(self.current + i) % len(self.slots)]:
+                if not timer.cancelled and not timer.rounds:
+                    return max(0.0, self.last + i * self.tick - time.monotonic())
+        return len(self.slots) * self.tick
+
+    def advance(self):
+        """ Run the callbacks of every expired timer"""
+        now = time.monotonic()
+        if not self.pending:
+            self.last = now
+            return
+        while now - self.last >= self.tick:
+            self.last += self.tick
+            self.current = (self.current + 1) % len(self.slots)
+            slot = self.slots[self.current]
+            if not slot:
+                continue
+            self.slots[self.current] = keep = []
+            for timer in slot:
+                if timer.cancelled:
+                    self.pending -= 1
+                elif timer.rounds:
+                    timer.rounds -= 1
+                    keep.append(timer)
+                else:
+                    self.pending -= 1
+                    timer.callback(*timer.args)
+
+
+class SerialSelector(object):
+    """ Block until one of the serial ports is readable, a deadline expires or wakeup() is called"""
+
+    def __init__(self, ports):
+        self.selector = selectors.DefaultSelector()
+        self.polled = list()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        os.set_blocking(self._wakeup_w, False)
+        self.selector.register(self._wakeup_r, selectors.EVENT_READ, None)
+        for port in ports:
+            try:
+                self.selector.register(port.fileno(), selectors.EVENT_READ, port)
+            except (AttributeError, OSError, ValueError):
+                LOGGER.debug(f"{port.name} can't be selected, it will be polled")
+                self.polled.append(port)
+
+    def wakeup(self):
+        try:
+            os.write(self._wakeup_w, b'\0')
+        except BlockingIOError:
+            pass
+
+    def wait(self, timeout=None):
+        if self.polled:
+            timeout = POLL_INTERVAL if timeout is None else min(timeout, POLL_INTERVAL)
+        ready = list()
+        for key, _ in self.selector.select(timeout):
+            if key.data is None:
+                try:
+                    while os.read(self._wakeup_r, 64):
+                        pass
+                except BlockingIOError:
+                    pass
+            else:
+                ready.append(key.data)
+        ready.extend(port for port in self.polled if port.in_waiting)
+        return ready
+
+    def close(self):
+        self.selector.close()
+        os.close(self._wakeup_r)
+        os.close(self._wakeup_w)
@@ -0,0 +1,169 @@
+""" Firmware update of every Domuino node in ms-config.yaml.
+
+Nodes on the same bus are updated one at a time, buses run in parallel. Completed nodes are
+recorded in a state file, so a new run with the same hex file resumes after the failed ones.
+The hub (multi_serial_port.py -L) must not be running on the same ports.
+"""
+import os
+import json
+import time
+import logging
+import argparse
+import threading
+
+import serial
+
+from simpledude import SimpleDude, BAUD_RATE, load_hex, page_digest, boot_baudrate
+from framing import FrameDecoder
+from multi_serial_port import (Packet, QUERIES, PACKET_HEADER, MAX_PACKET_SIZE, BROADCAST, PORTS, BASEDIR,
+                               FLASH_MANIFEST, check_msg, valid_frame, config)
+
+LOGGER = logging.getLogger(__name__)
+
+FLEET_STATE = BASEDIR + "/fleet-state.json"
+BOOT_TIMEOUT = 3.0  # s, from the PROGRAM command to the bootloader answering
+LOCATE_TIMEOUT = 0.3  # s, waiting the PING reply when looking for the bus of a node
+
+
+class FleetState(object):
+    """ Result of every node for one firmware image, saved after each node"""
+
+    def __init__(self, path, image, restart=False):
+        self.path = path
+        self.image = page_digest(image.image)
+        self.lock = threading.Lock()
+        self.nodes = dict()
+        if not restart and os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            if data.get('image') == self.image:
+                self.nodes = {int(net): report for net, report in data['nodes'].items()}
+
+    def done(self, net):
+        return self.nodes.get(net, {}).get('status') == "OK"
+
+    def update(self, net, report):
+        with self.lock:
+            self.nodes[net] = report
+            with open(self.path + ".tmp", "w") as f:
+                json.dump({'image': self.image, 'nodes': self.nodes}, f, indent=1)
+            os.replace(self.path + ".tmp", self.path)
+
+
+def locate(net, ports):
+    """ Port where the node answers a PING, None if it is silent everywhere"""
+    for port in ports:
+        port.reset_input_buffer()
+        port.write(Packet(bytes([QUERIES["PING"]]), dest=net).serialize())
+        decoder = FrameDecoder(PACKET_HEADER, MAX_PACKET_SIZE, check=valid_frame)
+        deadline = time.monotonic() + LOCATE_TIMEOUT
+        while time.monotonic() < deadline:
+            if not decoder.readinto(port):
+                time.sleep(0.005)
+                continue
+            for msg in decoder.frames():
+                received = check_msg(msg, verified=True)
+                if received and received.source == net:
+                    return port
+    return None
+
+
+def assign(nodes, ports):
+    """ {port: [(name, net), ...]} from the `bus:` key of the nodes, locating the others with a PING"""
+    buses = {port: list() for port in ports}
+    for name, net in nodes:
+        bus = config[name].get('bus')
+        port = None
+        for i, p in enumerate(ports):
+            if bus == i or bus == p.name:
+                port = p
+        if port is None:
+            port = ports[0] if len(ports) == 1 else locate(net, ports)
+        if port is None:
+            LOGGER.error(f"{name} ({net}) not found on any bus")
+            continue
+        buses[port].append((name, net))
+    return buses
+
+
+def update_node(port, name, net, hexfile, differential):
+    report = {'name': name, 'status': "FAILED", 'bytes': 0, 'seconds': 0.0}
+    start = time.monotonic()
+    try:
+        port.reset_input_buffer()
+        port.write(Packet(bytes([QUERIES["PROGRAM"]]), dest=net).serialize())
+        dude = SimpleDude(port, hexfile=hexfile, mode485=True)
+        # Optiboot resets into the application at the first byte it can't parse: talk at its rate from the start
+        baudrate = boot_baudrate(net)
+        if baudrate:
+            port.flush()
+            port.baudrate = baudrate
+        if not dude.wait_bootloader(timeout=BOOT_TIMEOUT):
+            report['status'] = "NO BOOTLOADER"
+        else:
+            report['baudrate'] = dude.negotiate(baudrate)
+            if dude.program(differential=differential, manifest=FLASH_MANIFEST, verify=True, compress=True):
+                report['status'] = "OK"
+        report['bytes'] = dude.written
+        report['retries'] = dude.retries
+    except Exception as e:
+        report['error'] = str(e)
+    finally:
+        # The nodes' firmware talks at the bus rate
+        port.baudrate = BAUD_RATE
+    report['seconds'] = round(time.monotonic() - start, 2)
+    report['bytes/s'] = round(report['bytes'] / report['seconds']) if report['seconds'] else 0
+    return report
+
+
+def update_bus(port, nodes, hexfile, state, differential):
+    for name, net in nodes:
+        if state.done(net):
+            LOGGER.info(f"{port.name} {name} ({net}) already updated")
+            continue
+        LOGGER.info(f"{port.name} {name} ({net}) updating")
+        report = update_node(port, name, net, hexfile, differential)
+        state.update(net, report)
+        LOGGER.info(f"{port.name} {name} ({net}) {report['status']} {report['bytes']} bytes in {report['seconds']} s "
+                    f"({report['bytes/s']} bytes/s)")
+
+
+def update_fleet(hexfile, com_ports=PORTS, nets=None, state_file=FLEET_STATE, restart=False, differential=True):
+    """ Update the nodes (all the configured ones when nets is None), return the state with a report per node"""
+    state = FleetState(state_file, load_hex(hexfile), restart=restart)
+    nodes = [(name, settings['net']) for name, settings in config.items()
+             if settings['net'] != BROADCAST and (not nets or settings['net'] in nets)]
+    ports = [serial.serial_for_url(port, baudrate=BAUD_RATE, timeout=0.5) for port in com_ports]
+    start = time.monotonic()
+    workers = [threading.Thread(target=update_bus, args=(port, bus_nodes, hexfile, state, differential),
+                                name=f"Fleet {port.name}")
+               for port, bus_nodes in assign(nodes, ports).items() if bus_nodes]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    for port in ports:
+        port.close()
+
+    reports = [state.nodes[net] for _, net in nodes if net in state.nodes]
+    ok = sum(1 for report in reports if report['status'] == "OK")
+    LOGGER.info(f"{ok}/{len(nodes)} nodes updated in {time.monotonic() - start:.1f} s, "
+                f"{sum(report['bytes'] for report in reports)} bytes sent")
+    return state
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Update the firmware of the Domuino nodes")
+    parser.add_argument("hexfile", help="Firmware to flash")
+    parser.add_argument("-p", "--ports", nargs="+", default=PORTS, help="Communication ports, one per bus")
+    parser.add_argument("-n", "--nodes", type=int, nargs="+", help="Nodes to update (default: all)")
+    parser.add_argument("-s", "--state", default=FLEET_STATE, help="State file used to resume")
+    parser.add_argument("--restart", action="store_true", help="Update again the nodes already done")
+    parser.add_argument("--full", action="store_true", help="Write every page, not only the changed ones")
+    args = parser.parse_args()
+
+    state = update_fleet(args.hexfile, com_ports=args.ports, nets=args.nodes, state_file=args.state,
+                         restart=args.restart, differential=not args.full)
+    for net, report in sorted(state.nodes.items()):
+        print(f"{net:>6} {report['name']:<14} {report['status']:<14} {report['bytes']:>6} bytes "
+              f"{report['seconds']:>7} s {report['bytes/s']:>6} bytes/s")
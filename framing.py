@@ -0,0 +1,86 @@
+class FrameDecoder(object):
+    """ Incremental decoder for fixed size frames starting with `header`.
+
+    Bytes are kept in a fixed bytearray, so partial frames survive across reads and nothing is
+    reallocated. frames() yields memoryviews of the frame body (header stripped) that are only
+    valid until the buffer is written again: copy what has to be kept.
+    check(frame) validates a whole frame (header included), a failing frame makes the decoder
+    resynchronise on the next header found after its first byte.
+    """
+
+    def __init__(self, header, size, check=None, capacity=None):
+        self.header = header
+        self.size = size
+        self.check = check
+        self.buffer = bytearray(capacity or size * 16)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def space(self):
+        """ Writable view on the free tail of the buffer"""
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif len(self.buffer) - self.end < self.size and self.start:
+            # Move the unparsed bytes to the front, same length assignment never resizes the buffer
+            length = self.end - self.start
+            self.buffer[:length] = self.view[self.start:self.end]
+            self.start, self.end = 0, length
+        if self.end == len(self.buffer):
+            # Full of garbage that never formed a frame, forget the oldest half
+            self.dropped += len(self.buffer) // 2
+            self.start = len(self.buffer) // 2
+            return self.space()
+        return self.view[self.end:]
+
+    def commit(self, count):
+        self.end += count
+
+    def decode(self, data):
+        """ Append `data` to the buffer and yield the frames it completes"""
+        data = memoryview(data)
+        while True:
+            space = self.space()
+            count = min(len(space), len(data))
+            space[:count] = data[:count]
+            self.commit(count)
+            data = data[count:]
+            yield from self.frames()
+            if not data:
+                return
+
+    def readinto(self, port):
+        """ Move the bytes waiting on a serial port into the buffer, return how many were read"""
+        waiting = port.in_waiting
+        if not waiting:
+            return 0
+        space = self.space()
+        count = port.readinto(space[:min(len(space), waiting)]) or 0
+        self.commit(count)
+        return count
+
+    def frames(self):
+        header = self.header
+        while True:
+            index = self.buffer.find(header, self.start, self.end)
+            if index < 0:
+                # Keep the bytes that could be the beginning of a split header
+                keep = max(self.start, self.end - len(header) + 1)
+                self.dropped += keep - self.start
+                self.start = keep
+                return
+            self.dropped += index - self.start
+            self.start = index
+            if self.end - index < self.size:
+                return
+            frame = self.view[index:index + self.size]
+            if self.check is None or self.check(frame):
+                self.start = index + self.size
+                yield frame[len(header):]
+            else:
+                self.start = index + 1
+                self.dropped += 1
@@ -0,0 +1,156 @@
+""" Liveness of the nodes, as a circuit breaker in front of the packet scheduler.
+
+Any frame from a node (HBT, MEM, ACK...) marks it up. Packets that expire without an answer make
+it suspect, then down: packets to a down node are held back (or dropped) instead of burning the
+whole timeout again and again, and the node is probed with PING until it answers.
+The ACK latency measured on every node sets its retry delay and timeout (RFC 6298 style).
+"""
+import time
+import threading
+
+UP = "up"
+SUSPECT = "suspect"
+DOWN = "down"
+
+SUSPECT_AFTER = 1  # expired packets in a row
+DOWN_AFTER = 3
+PROBE_INTERVAL = 5.0  # s, first PING to a down node, doubled up to MAX_PROBE_INTERVAL
+MAX_PROBE_INTERVAL = 60.0
+MIN_TIMEOUT = 0.1  # s
+# Sends of a packet (first one included) before it expires, and of the PING probing a down node
+RETRIES = 4
+PROBE_RETRIES = 1
+
+
+class NodeHealth(object):
+    __slots__ = ('state', 'failures', 'srtt', 'rttvar', 'last_seen', 'next_probe', 'probe_interval')
+
+    def __init__(self):
+        self.state = UP
+        self.failures = 0
+        self.srtt = None
+        self.rttvar = None
+        self.last_seen = None
+        self.next_probe = None
+        self.probe_interval = PROBE_INTERVAL
+
+
+class Liveness(object):
+    """ Health of every node seen or addressed, changed(net, old, new) is called on every transition.
+
+    One tracker is shared by the bus threads: accept(net) limits the probes to the nodes of a bus.
+    """
+
+    def __init__(self, changed=None, suspect_after=SUSPECT_AFTER, down_after=DOWN_AFTER,
+                 probe_interval=PROBE_INTERVAL, max_probe_interval=MAX_PROBE_INTERVAL):
+        self.nodes = dict()
+        self.lock = threading.RLock()
+        self.changed = changed
+        self.suspect_after = suspect_after
+        self.down_after = down_after
+        self.probe_interval = probe_interval
+        self.max_probe_interval = max_probe_interval
+
+    def _node(self, net):
+        node = self.nodes.get(net)
+        if node is None:
+            with self.lock:
+                node = self.nodes.get(net)
+                if node is None:
+                    node = NodeHealth()
+                    node.probe_interval = self.probe_interval
+                    self.nodes[net] = node
+        return node
+
+    def _set(self, net, node, state):
+        if node.state != state:
+            old, node.state = node.state, state
+            if self.changed:
+                self.changed(net, old, state)
+
+    def state(self, net):
+        node = self.nodes.get(net)
+        return node.state if node else UP
+
+    def down(self):
+        with self.lock:
+            return [net for net, node in self.nodes.items() if node.state == DOWN]
+
+    def seen(self, net, now=None):
+        """ A frame came from net"""
+        node = self._node(net)
+        with self.lock:
+            node.last_seen = now if now is not None else time.monotonic()
+            node.failures = 0
+            node.next_probe = None
+            node.probe_interval = self.probe_interval
+            self._set(net, node, UP)
+
+    def acked(self, net, latency, now=None):
+        """ net answered a packet after latency seconds"""
+        node = self._node(net)
+        with self.lock:
+            if node.srtt is None:
+                node.srtt, node.rttvar = latency, latency / 2
+            else:
+                node.rttvar = 0.75 * node.rttvar + 0.25 * abs(node.srtt - latency)
+                node.srtt = 0.875 * node.srtt + 0.125 * latency
+        self.seen(net, now)
+
+    def failed(self, net, now=None):
+        """ A packet to net expired without answer"""
+        node = self._node(net)
+        with self.lock:
+            node.failures += 1
+            if node.failures >= self.down_after:
+                if node.state != DOWN:
+                    node.next_probe = (now if now is not None else time.monotonic()) + node.probe_interval
+                self._set(net, node, DOWN)
+            elif node.failures >= self.suspect_after:
+                self._set(net, node, SUSPECT)
+
+    def allow(self, net):
+        """ False while the circuit of net is open"""
+        node = self.nodes.get(net)
+        return node is None or node.state != DOWN
+
+    def probes(self, now=None, accept=None):
+        """ Down nodes (accept(net) ones only) due for a PING, their next probe is pushed back"""
+        now = now if now is not None else time.monotonic()
+        due = list()
+        with self.lock:
+            for net, node in self.nodes.items():
+                if node.state == DOWN and node.next_probe is not None and node.next_probe <= now and \
+                        (accept is None or accept(net)):
+                    node.probe_interval = min(self.max_probe_interval, node.probe_interval * 2)
+                    node.next_probe = now + node.probe_interval
+                    due.append(net)
+        return due
+
+    def next_probe(self, accept=None):
+        """ Seconds to the next probe of the accept(net) nodes, None when none of them is down"""
+        with self.lock:
+            times = [node.next_probe for net, node in self.nodes.items()
+                     if node.state == DOWN and node.next_probe and (accept is None or accept(net))]
+        return max(0.0, min(times) - time.monotonic()) if times else None
+
+    def retry_delay(self, net, default):
+        """ Wait before sending again: no less than the time the ACK can take"""
+        node = self.nodes.get(net)
+        if node is None or node.srtt is None:
+            return default
+        return max(default, node.srtt + 4 * node.rttvar)
+
+    def timeout(self, net, default, retry_delay=0.0):
+        """ Time before a packet to net expires: never below default for a node up or suspect, whose
+        retries are what gets a flaky link through. Only the probes of a down node get a shorter one.
+        """
+        node = self.nodes.get(net)
+        if node is None:
+            return default
+        if node.state != DOWN:
+            return max(default, RETRIES * self.retry_delay(net, retry_delay))
+        if node.srtt is None:
+            # Never answered: shrink the default like the budget
+            return max(MIN_TIMEOUT, default * PROBE_RETRIES / RETRIES)
+        return min(default, max(MIN_TIMEOUT, PROBE_RETRIES * self.retry_delay(net, retry_delay)))
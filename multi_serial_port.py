@@ -1,18 +1,27 @@
-import datetime
 import time
 import struct
 import logging
 import argparse
 import subprocess
 import os
+import threading
 import yaml
 import collections
+import functools
 import ast
 
-from PyCRC.CRC16 import CRC16
 import serial
 
-from simpledude import SimpleDude
+from simpledude import SimpleDude, BAUD_RATE, FLASH_MANIFEST, boot_baudrate, record_boot_baudrate
+from eventloop import SerialSelector, TimerWheel
+from scheduler import PacketScheduler, BROADCAST
+from framing import FrameDecoder
+from crc16 import crc16, crc16_bytes
+from configwatch import ConfigWatcher
+from eventlog import EventLog, JsonlSink
+from sensorstore import SensorStore, SENSORS
+from nodestate import NodeTable, StateServer, HTTP_PORT
+from liveness import Liveness
 from nbstreamreader import NonBlockingStreamReader as NBSR
 
 PACKET_HEADER = b'\x08\x70'
@@ -20,6 +29,9 @@ NODE_ID = 1
 MAX_PAYLOAD_SIZE = 13
 MAX_PACKET_SIZE = 8 + MAX_PAYLOAD_SIZE  # 2 HEADER + 2 SOURCE + 2 DEST + 2 CRC
 PACKET_TIMEOUT = 0.5
+HOLD_TIME = 2.0  # s, packets held for a node down expire after it: a late LIGHT toggle is worse than a lost one
+BUS_WINDOW = 4  # Nodes that can be waiting for an ACK at the same time, one reply slot on the line
+INIT_PAUSE = 4
 
 # PORTS = ['COM1', 'COM2']
 # PORTS = ['COM13']
@@ -89,20 +101,67 @@ QUERIES = {
     0xA7: "LCD",
 }
 
-logging.basicConfig(level=logging.DEBUG)
+# Commands that set a state of the node, with the leading bytes of their data that tell which one:
+# a newer packet with the same bytes supersedes the unsent one (LCDPRINT: row and column).
+# Not LIGHT: every switch sends the same one-hot frame on each press, the relay node toggles that output
+COALESCE = {
+    QUERIES["LCDPRINT"]: 3,
+    QUERIES["CONFIG"]: 2,
+    QUERIES["MEM"]: 1,
+    QUERIES["VERSION"]: 1,
+    QUERIES["PING"]: 1,
+}
+
 LOGGER = logging.getLogger(__name__)
+EVENTS = EventLog(LOGGER, names=QUERIES)
+# SensorStore receiving the values of the nodes (multi_serial_port -s)
+STORE = None
 
 
 class Packet(object):
+    """ Domuino packet, the wire image is built once and reused until a field changes"""
+    __slots__ = ('_source', '_dest', '_data', 'crc', '_wire')
+    header = PACKET_HEADER
+    # Frame after the header: SOURCE, DEST, PAYLOAD (zero padded), CRC
+    BODY = struct.Struct(f"<HH{MAX_PAYLOAD_SIZE}s2s")
+
     def __init__(self, data=None, source=1, dest=255):
-        self.header = PACKET_HEADER
+        self._wire = None
         self.source = source
         self.dest = dest
         self.data = data
         self.crc = None
 
+    @property
+    def source(self):
+        return self._source
+
+    @source.setter
+    def source(self, value):
+        self._source = value
+        self._wire = None
+
+    @property
+    def dest(self):
+        return self._dest
+
+    @dest.setter
+    def dest(self, value):
+        self._dest = value
+        self._wire = None
+
+    @property
+    def data(self):
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        # Keep an immutable copy, so the cached wire image can't go stale behind our back
+        self._data = bytes(value) if isinstance(value, (bytearray, memoryview)) else value
+        self._wire = None
+
     def CRC(self, data):
-        return CRC16(modbus_flag=True).calculate(bytes(data)).to_bytes(2, byteorder='little')
+        return crc16_bytes(data)
 
     @staticmethod
     def _serialize(data):
@@ -112,30 +171,33 @@ class Packet(object):
             ret = bytes([data])
         return ret
 
+    @classmethod
+    def from_buffer(cls, data):
+        """ Build a Packet from a received frame body (header stripped), data can be a memoryview"""
+        return cls.__new__(cls).deserialize(data)
+
     def deserialize(self, data):
-        self.source = struct.unpack("H", data[0:2])[0]
-        self.dest = struct.unpack("H", data[2:4])[0]
-        self.data = data[4:-2] if data is not None else 0
-        self.crc = data[-2:]
+        self._source, self._dest, self._data, self.crc = self.BODY.unpack_from(data)
+        self._wire = None
         return self
 
     def serialize(self):
-        r = self.header
-        r += struct.pack('H', self.source)
-        r += struct.pack('H', self.dest)
-        r += self.data + bytes(MAX_PAYLOAD_SIZE - len(self.data))
-        r += self.CRC(r)
-        return r
+        if self._wire is None:
+            wire = bytearray(MAX_PACKET_SIZE)
+            self.BODY.pack_into(wire, len(self.header), self.source, self.dest, self.data, b'')
+            wire[:len(self.header)] = self.header
+            wire[-2:] = self.CRC(memoryview(wire)[:-2])
+            self._wire = bytes(wire)
+        return self._wire
 
 
-def parse_packet(packet):
+def parse_packet(packet, bus=None):
     try:
         if packet.data[0] not in QUERIES:
             # self.logger.error("Error packet: %s", packet.serialize(), extra=self.logextra)
             return 0
         # self.logger.info("Parsing command %s", QUERIES[packet.data[0]])
         value = {'type': "->HUB",
-                 'time': datetime.datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
                  'node': packet.source,
                  'msg': QUERIES[packet.data[0]],
                  'reply': bytes([QUERIES['ACK'], ])}
@@ -161,18 +223,33 @@ def parse_packet(packet):
             pass
         elif value['msg'] == "VERSION":
             value.update({'version': struct.unpack("h", packet.data[1:3])[0]})
-        elif value['msg'] == "PROGRAM":
-            dude.program()
-        LOGGER.info(value)
+        NODES.update(packet.source, value)
+        if STORE is not None and value['msg'] in SENSORS:
+            for field, metric in SENSORS[value['msg']]:
+                STORE.add(packet.source, metric, value[field])
+        if EVENTS.enabled(logging.INFO):
+            EVENTS.log(logging.INFO, "->HUB", bus, packet.source, packet.data[0],
+                       {k: v for k, v in value.items() if k not in ('type', 'node', 'msg', 'reply')})
     except Exception as e:
         raise Exception(f'{e} - {value}')
     return value
 
 
-def check_msg(data):
+def coalesce_key(packet):
+    """ Key of the state set by packet, None when it must be sent as it is"""
+    size = COALESCE.get(packet.data[0])
+    return bytes(packet.data[:size]) if size else None
+
+
+def valid_frame(frame):
+    """ CRC check of a whole frame, header included"""
+    return crc16(frame) == 0
+
+
+def check_msg(data, verified=False):
     if len(data) == MAX_PACKET_SIZE - 2:
-        a = Packet().deserialize(data)
-        if a.crc == a.CRC(PACKET_HEADER + data[:-2]):
+        a = Packet.from_buffer(data)
+        if verified or a.crc == a.CRC(PACKET_HEADER + data[:-2]):
             if a.dest == NODE_ID:
                 if data != 0:
                     return a
@@ -202,19 +279,31 @@ def shell(command, work_dir=""):
             print(output.decode("UTF-8"), end="")
         if error:
             print(error.decode("UTF-8"), end="")
+    return p.returncode
 
 
-def compile_bootloader(make, env, address, workdir):
+def compile_bootloader(make, env, address, workdir, baudrate=BAUD_RATE, compression=False):
+    """ Build optiboot for a node, compression adds the fill/copy page commands (see stk500sim.py).
+
+    flash_bootloader() records the rate for the node, the flashing tools talk to its bootloader at that rate only.
+    """
     make = f"{make} " \
-        f"ENV={env} BAUD_RATE=38400 LED=D2 LED_START_FLASHES=5 " \
+        f"ENV={env} BAUD_RATE={baudrate} LED=D2 LED_START_FLASHES=5 " \
+        f"COMPRESSION={int(compression)} " \
         f"SN_MAJOR={address // 0xff} SN_MINOR={address % 0xff} pro8"
     #        cp_command = "cp" if os.name == "posix" else "copy"
     #        cp = "{} {} {}".format(cp_command, source, destination)
     shell("{make}", work_dir=workdir)
 
 
-def flash_bootloader(bootloader):
-    shell(AVRCMD + f" -u -U flash:w:\"{bootloader}\":i -vv")
+def flash_bootloader(bootloader, address=None, baudrate=BAUD_RATE):
+    """ Write the bootloader built for node address, its rate is recorded once it is in flash"""
+    if shell(AVRCMD + f" -u -U flash:w:\"{bootloader}\":i -vv"):
+        LOGGER.error(f"{bootloader}: bootloader not flashed")
+        return False
+    if address is not None:
+        record_boot_baudrate(address, baudrate)
+    return True
 
 
 def update_fuses(low=0xDE, high=0xDC, extend=0xFA):
@@ -225,12 +314,21 @@ def mdelay(value):
     """ Delay in milliseconds"""
     if value > 200:
         raise BaseException(f"{value} too long for udelay. Max value accepted is 200!")
-    start = time.time()
-    while time.time() < (start + (value / 1000)):
-        pass
+    time.sleep(value / 1000)
     return time.time()
 
 
+def format_args(args, values):
+    """ Fill the {fields} of the string arguments of a command"""
+    if type(args) is dict:
+        return {k: format_args(v, values) for k, v in args.items()}
+    if type(args) is list:
+        return [format_args(v, values) for v in args]
+    if type(args) is str:
+        return args.format(**values)
+    return args
+
+
 def prepare_commands(dest, commands, config, format_values={}):
     def append(msg, packets):
         if len(msg) < MAX_PAYLOAD_SIZE:
@@ -246,7 +344,7 @@ def prepare_commands(dest, commands, config, format_values={}):
         if type(msg) is dict:
             for k1, v1 in msg.items():  # command with 1 arg
                 if format_values:
-                    v1 = ast.literal_eval(str(v1).format(**format_values))
+                    v1 = format_args(v1, format_values)
                 if type(v1) is dict:
                     for k2, v2 in v1.items():  # series of commands with 1 arg
                         append({"id": dest, "cmd": bytearray((QUERIES[k1], QUERIES[k2], v2))}, packets)
@@ -272,34 +370,169 @@ def prepare_commands(dest, commands, config, format_values={}):
     return packet_queue
 
 
+class CommandTemplate(object):
+    """ Command with {fields} in its string arguments, compiled once.
+
+    The static bytes around the fields are precomputed, each field is a bound str.format,
+    so rendering costs one format call per field. A rendered payload longer than MAX_PAYLOAD_SIZE
+    is logged: the packet only carries its first MAX_PAYLOAD_SIZE bytes.
+    """
+    __slots__ = ('dest', 'parts')
+
+    def __init__(self, dest, command, args):
+        self.dest = dest
+        self.parts = list()
+        static = bytearray([QUERIES[command]])
+        for arg in args:
+            if type(arg) is int:
+                static.append(arg)
+            elif "{" not in arg:
+                static += arg.encode("UTF-8")
+            else:
+                if static:
+                    self.parts.append(bytes(static))
+                    static = bytearray()
+                self.parts.append(arg.format)
+        if static:
+            self.parts.append(bytes(static))
+
+    def __call__(self, values):
+        data = b"".join(part if type(part) is bytes else part(**values).encode("UTF-8") for part in self.parts)
+        if len(data) > MAX_PAYLOAD_SIZE:
+            LOGGER.warning(f"{QUERIES[data[0]]} to {self.dest} exceeds the maximum size of {MAX_PAYLOAD_SIZE} "
+                           f"characters, {data[MAX_PAYLOAD_SIZE:]} cut off")
+        return Packet(data, dest=self.dest),
+
+
+def is_template(commands):
+    """ True when a command has string arguments with {fields} to fill from the event values"""
+    if type(commands) is dict:
+        return any(is_template(v) for v in commands.values())
+    if type(commands) is list:
+        return any(is_template(v) for v in commands)
+    return type(commands) is str and "{" in commands
+
+
+CompiledNode = collections.namedtuple('CompiledNode', 'settings rules unconfigured deps')
+
+
+class RuleIndex(object):
+    """ Rules of a configuration compiled once: (node net, msg, switch index) -> actions.
+
+    An action is a tuple of ready Packets, or a callable building the packets from the event
+    values when the command is a template (e.g. DHT values printed on an LCD).
+    Given the index of a previous configuration, the nodes whose settings and destinations
+    did not change are reused instead of compiled again.
+    """
+
+    def __init__(self, config, previous=None):
+        self.config = config
+        self.nets = dict()
+        self.names = dict()
+        self.nodes = dict()
+        self.rules = dict()
+        # (net, msg) of SWITCH/DHT events that have no valid rules
+        self.unconfigured = set()
+        self.changed = list()
+        for name, settings in config.items():
+            self.nets[settings['net']] = name
+            self.names[name] = settings['net']
+        for name, settings in config.items():
+            node = previous.reusable(name, settings, self.names) if previous else None
+            if node is None:
+                node = self.compile_node(settings)
+                self.changed.append(name)
+            self.nodes[name] = node
+            self.rules.update(node.rules)
+            self.unconfigured.update(node.unconfigured)
+
+    def reusable(self, name, settings, names):
+        node = self.nodes.get(name)
+        if node and node.settings == settings and all(names.get(d, d) == self.names.get(d, d) for d in node.deps):
+            return node
+        return None
+
+    def compile_node(self, settings):
+        net = settings['net']
+        rules = dict()
+        unconfigured = set()
+        deps = set()
+        for msg in ('SWITCH', 'DHT'):
+            try:
+                node_commands = settings.get(msg)
+                if msg == 'SWITCH':
+                    for idx, lights in node_commands.items():
+                        rules[(net, msg, idx)] = [a for light in lights for a in self.compile_actions(light, deps)]
+                else:
+                    if type(node_commands) is dict:
+                        node_commands = [node_commands]
+                    rules[(net, msg, None)] = [a for cmd in node_commands for a in self.compile_actions(cmd, deps)]
+            except Exception as e:
+                if msg in settings:
+                    LOGGER.critical(f"{self.nets[net]} {msg}: {e}")
+                unconfigured.add((net, msg))
+        return CompiledNode(settings, rules, unconfigured, deps)
+
+    def compile_actions(self, rule, deps):
+        dest = list(rule.keys())[0]
+        deps.add(dest)
+        commands = rule.get(dest)
+        actions = list()
+        for command in commands if type(commands) is list else [commands]:
+            if not is_template(command):
+                actions.append(tuple(prepare_commands(dest, command, self.config)))
+            elif type(command) is dict and all(type(args) is list for args in command.values()):
+                net = dest if type(dest) is int else self.config[dest]['net']
+                actions.extend(CommandTemplate(net, name, args) for name, args in command.items())
+            else:
+                actions.append(functools.partial(prepare_commands, dest, command, self.config))
+        return actions
+
+    def actions(self, net, msg, idx=None):
+        if (net, msg) in self.unconfigured:
+            raise KeyError(f"{msg} is not configured for node {net}")
+        return self.rules.get((net, msg, idx), ())
+
+
+_rule_indexes = dict()
+
+
+def _register(index):
+    if len(_rule_indexes) >= 8:
+        _rule_indexes.clear()
+    _rule_indexes[id(index.config)] = index
+    return index
+
+
+def rule_index(config):
+    """ Compiled rules of config, built on first use"""
+    index = _rule_indexes.get(id(config))
+    if index is None or index.config is not config:
+        index = _register(RuleIndex(config))
+    return index
+
+
 def execute(value, config):
     cmds = collections.deque()
-    node = config.get(net_reverseid.get(value.get('node')))
-    if node:
+    index = rule_index(config)
+    net = value.get('node')
+    if net in index.nets:
         try:
-            node_commands = node.get(value['msg'])
+            actions = list()
             if value['msg'] == 'SWITCH':
                 for idx, switch in enumerate(value['state']):
                     if switch == 1:
-                        for light in node_commands.get(idx + 1, []):
-                            dest = list(light.keys())[0]
-                            cmds.extend(prepare_commands(dest, light.get(dest), config))
+                        actions.extend(index.actions(net, 'SWITCH', idx + 1))
             elif value['msg'] == 'DHT':
-                if type(node_commands) is dict:
-                    dest = list(node_commands.keys())[0]
-                    cmds.extend(prepare_commands(dest, node_commands.get(dest), config, value))
-                else:
-                    for cmd in node_commands:
-                        dest = list(cmd.keys())[0]
-                        cmds.extend(prepare_commands(dest, cmd.get(dest), config, value))
+                actions = index.actions(net, 'DHT')
+            for action in actions:
+                cmds.extend(action(value) if callable(action) else action)
         except Exception as e:
             LOGGER.critical(e)
-            value.update({'type': "[UNCONFIGURED]->HUB",
-                          'time': datetime.datetime.now().strftime("%d/%m/%Y %H:%M:%S")})
+            value['type'] = "[UNCONFIGURED]->HUB"
     else:
-        value.update({'type': "[UNKNOWN]->HUB",
-                      'time': datetime.datetime.now().strftime("%d/%m/%Y %H:%M:%S")})
-        LOGGER.error(value)
+        value['type'] = "[UNKNOWN]->HUB"
+        EVENTS.log(logging.ERROR, value['type'], None, net, value.get('msg'))
     return cmds
 
 
@@ -308,9 +541,25 @@ with open(CONFIG) as f:
     config = yaml.load(f, Loader=yaml.FullLoader)
 for dest, settings in config.items():
     net_reverseid[settings['net']] = dest
-
-# todo: sezione update software domuino da sistemare
-dude = None
+rule_index(config)
+# Last state of the nodes, filled by parse_packet()
+NODES = NodeTable(net_reverseid)
+
+
+def reload_config(path=CONFIG):
+    """ Read the configuration again and swap in the rules of the nodes that changed"""
+    global config, net_reverseid
+    with open(path) as f:
+        new_config = yaml.load(f, Loader=yaml.FullLoader)
+    previous = rule_index(config)
+    index = _register(RuleIndex(new_config, previous=previous))
+    removed = set(previous.nodes) - set(index.nodes)
+    # execute() picks the rules through config: rebinding it switches the serial loop in one step
+    net_reverseid = index.nets
+    NODES.names = net_reverseid
+    config = new_config
+    LOGGER.info(f"Configuration reloaded: changed {index.changed}, removed {sorted(removed)}")
+    return index
 
 # TODO: Gestire eventuali segmentation fault, vedi sotto
 # Mar 05 02:09:10 orangepipc kernel: Modules linked in: npreal2(O) zstd zram snd_soc_hdmi_codec sun4i_i2s mt7601u sun8i_codec_analog sun8i_adda_pr_regmap snd_s
@@ -330,13 +579,155 @@ dude = None
 # Mar 05 02:09:10 orangepipc systemd[1]: domuino.service: Main process exited, code=exited, status=139/n/a
 # Mar 05 02:09:10 orangepipc systemd[1]: domuino.service: Failed with result 'exit-code'.
 
-def run(packets_to_send=None, com_ports=PORTS, delay_send_s=0, delay_retry_ms=30, timeout=PACKET_TIMEOUT):
-    # todo: sezione update software domuino da sistemare
-    global dude
+class RoutingTable(object):
+    """ Node net -> bus, learned from the source of the received frames.
+
+    Nodes can be seeded with an optional `bus:` key in ms-config.yaml (port name or index in
+    the port list), what is seen on the bus wins over the configuration.
+    """
+
+    def __init__(self, buses):
+        self.buses = buses
+        self.learned = dict()
+        self.seeded = dict()
+
+    def seed(self, config):
+        seeded = dict()
+        for name, settings in config.items():
+            bus = settings.get('bus')
+            if bus is None:
+                continue
+            for i, b in enumerate(self.buses):
+                if bus == i or bus == b.port.name:
+                    seeded[settings['net']] = b
+                    break
+            else:
+                LOGGER.warning(f"{name}: unknown bus {bus}")
+        self.seeded = seeded
+
+    def learn(self, net, bus):
+        if self.learned.get(net) is not bus:
+            LOGGER.debug(f"Node {net} is on {bus.port.name}")
+            self.learned[net] = bus
+
+    def lookup(self, net):
+        """ Buses that must carry a packet for net"""
+        if net == BROADCAST:
+            return self.buses
+        bus = self.learned.get(net) or self.seeded.get(net)
+        return [bus] if bus else self.buses
+
+
+class Bus(threading.Thread):
+    """ One RS485 segment: reader, frame decoder, send queues and retries run in their own thread.
+
+    Packets produced by the rules are handed to dispatch(packets), shared by all the buses.
+    An error stops the thread: it is logged and failed (a threading.Event) is set.
+    """
+
+    def __init__(self, port, dispatch, routes=None, delay_send_s=0, delay_retry_ms=30, timeout=PACKET_TIMEOUT,
+                 window=BUS_WINDOW, health=None, defer=True, hold=HOLD_TIME, failed=None):
+        super().__init__(name=f"Bus {port.name}", daemon=True)
+        self.port = port
+        self.dispatch = dispatch
+        self.routes = routes
+        self.inbox = collections.deque()
+        self.selector = SerialSelector([port])
+        self.timers = TimerWheel()
+        self.decoder = FrameDecoder(PACKET_HEADER, MAX_PACKET_SIZE, check=valid_frame)
+        self.scheduler = PacketScheduler(self.timers, self.write, expired=self.expired, busy=self.busy,
+                                         window=window, timeout=timeout,
+                                         retry_delay=delay_retry_ms / 1000, spacing=delay_send_s,
+                                         health=health, probe=self.probe, defer=defer, hold=hold,
+                                         coalesce=coalesce_key, cost=2 * MAX_PACKET_SIZE * 10 / port.baudrate,
+                                         owns=self.owns, frame=MAX_PACKET_SIZE * 10 / port.baudrate)
+        self.stopped = threading.Event()
+        self.failed = failed
+        self.error = None
+
+    def stop(self):
+        self.stopped.set()
+        self.selector.wakeup()
+
+    def submit(self, packets):
+        """ Queue packets from any thread"""
+        self.inbox.extend(packets)
+        self.selector.wakeup()
+
+    def busy(self):
+        return self.port.in_waiting
+
+    def owns(self, net):
+        """ True when net is routed to this bus, the health tracker is shared by all of them"""
+        return self.routes is None or self in self.routes.lookup(net)
+
+    def program(self):
+        """ Flash DOMUINO_SOFTWARE on the node that asked for it, through this bus: its reader waits meanwhile"""
+        # todo: sezione update software domuino da sistemare
+        dude = SimpleDude(self.port, hexfile=DOMUINO_SOFTWARE, mode485=True, manifest=FLASH_MANIFEST)
+        if dude.wait_bootloader():
+            dude.program()
+        else:
+            LOGGER.error("Bootloader not answering")
 
-    packets_queue = collections.deque()
-    if packets_to_send:
-        packets_queue.extend(packets_to_send)
+    @staticmethod
+    def probe(dest):
+        return Packet(bytes([QUERIES["PING"]]), dest=dest)
+
+    def write(self, packet, again):
+        self.port.write(packet.serialize())
+        level = logging.DEBUG if again else logging.INFO
+        if EVENTS.enabled(level):
+            EVENTS.log(level, f"HUB[+{again}]->" if again else "HUB->", self.port.name, packet.dest,
+                       packet.data[0], packet.data[1:])
+
+    def expired(self, packet):
+        EVENTS.log(logging.INFO, "HUB->TIMEOUT", self.port.name, packet.dest, packet.data[0], packet.data[1:])
+
+    def receive(self):
+        while self.decoder.readinto(self.port):
+            for msg in self.decoder.frames():
+                received = check_msg(msg, verified=True)
+                if received:
+                    if self.routes:
+                        self.routes.learn(received.source, self)
+                    if self.scheduler.health:
+                        self.scheduler.health.seen(received.source)
+                    result = parse_packet(received, self.port.name)
+                    if result['msg'] == "PROGRAM":
+                        self.program()
+                    # A frame that is not the reply to an in flight packet is a new message from the node
+                    if self.scheduler.acknowledge(received.source, received.data[0]) is None:
+                        packet = Packet(result['reply'], dest=received.source)
+                        self.port.write(packet.serialize())
+                        EVENTS.log(logging.INFO, "HUB[REPLY]->", self.port.name, packet.dest, packet.data[0])
+                        self.dispatch(execute(result, config))
+
+    def run(self):
+        try:
+            while not self.stopped.is_set():
+                while self.inbox:
+                    self.scheduler.submit(self.inbox.popleft())
+                self.timers.advance()
+                self.scheduler.pump()
+                # Sleep until the port is readable, the next retry/send is due or packets are submitted
+                if self.selector.wait(self.timers.timeout()):
+                    self.receive()
+        except Exception as e:
+            LOGGER.exception(f"{self.port.name}: bus stopped")
+            self.error = e
+            if self.failed is not None:
+                self.failed.set()
+            return
+        counters = self.scheduler.counters
+        if counters:
+            LOGGER.info(f"{self.port.name}: {counters['coalesced']} packets coalesced, {counters['duplicates']} "
+                        f"duplicates dropped, {self.scheduler.saved:.2f} s of bus time saved")
+
+
+def run(packets_to_send=None, com_ports=PORTS, delay_send_s=0, delay_retry_ms=30, timeout=PACKET_TIMEOUT,
+        window=BUS_WINDOW, init_pause=INIT_PAUSE, watch=False, defer=True, hold=HOLD_TIME):
+    """ Run the hub until a bus fails, then exit with status 1: systemd restarts it"""
     ports = list()
     if type(com_ports) is list:
         for port in com_ports:
@@ -345,83 +736,36 @@ def run(packets_to_send=None, com_ports=PORTS, delay_send_s=0, delay_retry_ms=30
         ports = [serial.serial_for_url(com_ports, baudrate=38400, timeout=0.5)]
 
     LOGGER.debug("Init pause...")
-    time.sleep(4)
+    time.sleep(init_pause)
     LOGGER.debug("Start!")
-    # todo: sezione update software domuino da sistemare
-    dude = SimpleDude(ports[0], hexfile=DOMUINO_SOFTWARE, mode485=True)
-
-    packet_to_send = None
-    sent_timeout = 0
-    sent_again = 0
-    buffer = b''
-    while True:
-        for port in ports:
-            # buffer = port.read_all()
-            # if buffer:
-            buffer += port.read_all()
-            if buffer.find(PACKET_HEADER) >= 0 and len(buffer) >= MAX_PACKET_SIZE:
-                for msg in buffer.split(PACKET_HEADER)[1:]:
-                    received = check_msg(msg)
-                    if received:
-                        result = parse_packet(received)
-                        if not packet_to_send or (
-                                (packet_to_send.dest, packet_to_send.data[0]) != (received.source, received.data[0])
-                                and packet_to_send.dest != 255
-                        ):
-                            packet = Packet(result['reply'], dest=received.source)
-                            port.write(packet.serialize())
-                            value = {'type': "HUB[REPLY]->",
-                                     'time': datetime.datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
-                                     'node': packet.dest,
-                                     'msg': QUERIES[packet.data[0]],
-                                     'data': packet.data[1:]
-                                     }
-                            LOGGER.info(value)
-                            packets_queue.extend(execute(result, config))
-                        else:
-                            # Got a Reply for a previous write from this node
-                            packet_to_send = None
-                            sent_again = 0
-                buffer = b''
-            if port.inWaiting() == 0:
-                if packet_to_send:
-                    if time.time() - sent_timeout < timeout:
-                        # This packet has not reached destination so retry to send it
-                        mdelay(delay_retry_ms)
-                        port.write(packet_to_send.serialize())
-                        sent_again += 1
-                        value = {'type': f"HUB[+{sent_again}]->",
-                                 'time': datetime.datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
-                                 'node': packet_to_send.dest,
-                                 'msg': QUERIES[packet_to_send.data[0]],
-                                 'data': packet_to_send.data[1:]
-                                 }
-                        LOGGER.debug(value)
-                    else:
-                        value = {'type': "HUB->TIMEOUT",
-                                 'time': datetime.datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
-                                 'node': packet_to_send.dest,
-                                 'msg': QUERIES[packet_to_send.data[0]],
-                                 'data': packet_to_send.data[1:]
-                                 }
-                        LOGGER.info(value)
-                        packet_to_send = None
-                        sent_again = 0
-                elif packets_queue:
-                    # If all packets has reached destination pop another one from queue
-                    if delay_send_s:
-                        time.sleep(delay_send_s)
-
-                    packet_to_send = packets_queue.popleft()
-                    port.write(packet_to_send.serialize())
-                    value = {'type': "HUB->",
-                             'time': datetime.datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
-                             'node': packet_to_send.dest,
-                             'msg': QUERIES[packet_to_send.data[0]],
-                             'data': packet_to_send.data[1:]
-                             }
-                    LOGGER.info(value)
-                    sent_timeout = time.time()
+
+    buses = list()
+    failed = threading.Event()
+    routes = RoutingTable(buses)
+    health = Liveness(changed=lambda net, old, new: LOGGER.warning(f"Node {net_reverseid.get(net, net)}: {old} -> {new}"))
+
+    def dispatch(packets):
+        # Unicast packets go to the bus of their node, broadcasts and unknown nodes to every bus
+        for packet in packets:
+            for bus in routes.lookup(packet.dest):
+                bus.submit((packet,))
+
+    for port in ports:
+        buses.append(Bus(port, dispatch, routes=routes, delay_send_s=delay_send_s, delay_retry_ms=delay_retry_ms,
+                         timeout=timeout, window=window, health=health, defer=defer, hold=hold, failed=failed))
+    routes.seed(config)
+    if watch:
+        ConfigWatcher(CONFIG, lambda path: routes.seed(reload_config(path).config)).start()
+    if packets_to_send:
+        dispatch(packets_to_send)
+    for bus in buses:
+        bus.start()
+    failed.wait()
+    for bus in buses:
+        bus.stop()
+    for bus in buses:
+        bus.join()
+    raise SystemExit(1)
 
 
 if __name__ == "__main__":
@@ -440,32 +784,51 @@ if __name__ == "__main__":
     parser.add_argument('-I', "--setid", type=int, choices=range(2, 255), help="Set node id")
     parser.add_argument('-X', "--execute", help="Exec command")
     parser.add_argument('-P', "--program", action="store_true", help="Write software to node")
+    parser.add_argument('-D', "--diff", action="store_true", help="Write only the pages changed since the last flash")
+    parser.add_argument('-V', "--verify", action="store_true", help="Read back every page after writing it")
     parser.add_argument("-p", "--ports", help="Communication ports")
     parser.add_argument("-n", "--node", type=int, choices=range(1, 65535), help="Destination node")
+    parser.add_argument("-w", "--window", type=int, default=BUS_WINDOW, help="Nodes waiting for an ACK at the same time")
+    parser.add_argument("--fail-fast", action="store_true", help="Drop the packets of the nodes down, don't hold them")
+    parser.add_argument("--hold", type=float, default=HOLD_TIME, help="Seconds the packets of a node down are held")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Log retries and the other debug events")
+    parser.add_argument("-E", "--events", help="Append every event to this JSONL file")
+    parser.add_argument("-s", "--store", help="Directory of the sensor store")
+    parser.add_argument("--http", type=int, nargs="?", const=HTTP_PORT, help="Serve the node states on localhost")
 
     args = parser.parse_args()
+    LOGGER.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+    if args.events:
+        EVENTS.set_sink(JsonlSink(args.events))
+    if args.store:
+        STORE = SensorStore(args.store)
+    if args.http:
+        StateServer(NODES, port=args.http).start()
 
     com_ports = args.ports if args.ports else PORTS
     if args.loop:
-        run(packets_to_send=cmds, com_ports=com_ports)
+        run(packets_to_send=cmds, com_ports=com_ports, window=args.window, watch=True, defer=not args.fail_fast,
+            hold=args.hold)
     if args.config:
         for dest, settings in config.items():
             if not args.node or args.node == settings.get('net'):
                 parameters = settings.get('config')
                 if parameters:
                     cmds.extend(prepare_commands(dest, {"CONFIG": parameters}, config))
-        run(packets_to_send=cmds, com_ports=com_ports)
+        run(packets_to_send=cmds, com_ports=com_ports, window=args.window)
     elif args.scan:
         for i in net_reverseid.keys():
             cmds.extend(prepare_commands(i, "MEM", config))
-        run(packets_to_send=cmds, com_ports=com_ports)
+        run(packets_to_send=cmds, com_ports=com_ports, window=args.window)
     elif args.execute:
         cmds.extend(prepare_commands(args.node, ast.literal_eval("\"{}\"".format(args.execute)), config))
-        run(packets_to_send=cmds, com_ports=com_ports)
+        run(packets_to_send=cmds, com_ports=com_ports, window=args.window)
     elif args.setid:
         cmds.extend(prepare_commands(args.node, {"SETID": [args.setid % 0xff, args.setid // 0xff]}, config))
-        run(packets_to_send=cmds, com_ports=com_ports)
+        run(packets_to_send=cmds, com_ports=com_ports, window=args.window)
     elif args.program:
-        ser = serial.serial_for_url(args.ports, baudrate=38400, timeout=0.1)
+        ser = serial.serial_for_url(args.ports, baudrate=BAUD_RATE, timeout=0.1)
         dude = SimpleDude(ser, hexfile=DOMUINO_SOFTWARE)  # , mode485=True)
-        dude.program()
+        dude.negotiate(boot_baudrate(args.node) if args.node else None)
+        dude.program(differential=args.diff, manifest=FLASH_MANIFEST, verify=args.verify, compress=True)
+        dude.restore_baudrate()
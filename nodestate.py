@@ -0,0 +1,144 @@
+""" Last known state of every node, with a small JSON API on localhost.
+
+The bus threads are the only writers: every field is replaced with a new object, never changed in
+place, so other threads read a node without locks and always see whole values.
+
+    GET /nodes         all the nodes
+    GET /nodes/<net>   one node
+"""
+import json
+import time
+import logging
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+LOGGER = logging.getLogger(__name__)
+
+HTTP_PORT = 8485
+
+# Parsed value field copied into the node state for each message: {message: ((field, attribute), ...)}
+FIELDS = {
+    "SWITCH": (('state', 'switch'),),
+    "LIGHT": (('state', 'light'),),
+    "DHT": (('temperature', 'temperature'), ('humidity', 'humidity')),
+    "VERSION": (('version', 'version'),),
+    "MEM": (('value', 'mem'),),
+    "PIR": (('value', 'pir'),),
+    "LUX": (('value', 'lux'),),
+}
+
+
+class NodeState(object):
+    __slots__ = ('net', 'switch', 'light', 'temperature', 'humidity', 'version', 'mem', 'pir', 'lux',
+                 'last_seen', 'last_heartbeat', 'updated')
+
+    def __init__(self, net):
+        self.net = net
+        self.switch = None
+        self.light = None
+        self.temperature = None
+        self.humidity = None
+        self.version = None
+        self.mem = None
+        self.pir = None
+        self.lux = None
+        self.last_seen = None
+        self.last_heartbeat = None
+        # time.time() of the last change of every field
+        self.updated = dict()
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class NodeTable(object):
+    """ {net: NodeState}, names maps the nets to the node names of the configuration"""
+
+    def __init__(self, names=None):
+        self.nodes = dict()
+        self.names = names or dict()
+
+    def __getitem__(self, net):
+        return self.nodes[net]
+
+    def __contains__(self, net):
+        return net in self.nodes
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def get(self, net):
+        return self.nodes.get(net)
+
+    def update(self, net, value, now=None):
+        """ Record a parsed message of net"""
+        now = now if now is not None else time.time()
+        node = self.nodes.get(net)
+        if node is None:
+            node = NodeState(net)
+            # Visible to the readers only when complete
+            self.nodes[net] = node
+        msg = value.get('msg')
+        changed = dict(node.updated)
+        for field, attribute in FIELDS.get(msg, ()):
+            if field in value:
+                data = value[field]
+                setattr(node, attribute, list(data) if type(data) is list else data)
+                changed[attribute] = now
+        if msg == "HBT":
+            node.last_heartbeat = now
+        node.updated = changed
+        node.last_seen = now
+
+    def node(self, net):
+        """ State of net as a dict, None for an unknown node"""
+        node = self.nodes.get(net)
+        if node is None:
+            return None
+        state = node.as_dict()
+        state['name'] = self.names.get(net)
+        return state
+
+    def snapshot(self):
+        return {net: self.node(net) for net in list(self.nodes)}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    table = None
+
+    def do_GET(self):
+        parts = [part for part in self.path.split("?")[0].split("/") if part]
+        if parts == ["nodes"]:
+            self.reply(200, self.table.snapshot())
+        elif len(parts) == 2 and parts[0] == "nodes" and parts[1].isdigit() and int(parts[1]) in self.table:
+            self.reply(200, self.table.node(int(parts[1])))
+        else:
+            self.reply(404, {'error': f"{self.path} not found"})
+
+    def reply(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        LOGGER.debug(format, *args)
+
+
+class StateServer(threading.Thread):
+    """ Serve the table on http://host:port, localhost only by default"""
+
+    def __init__(self, table, host="127.0.0.1", port=HTTP_PORT):
+        super().__init__(name="StateServer", daemon=True)
+        handler = type("Handler", (_Handler,), {'table': table})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.port = self.server.server_address[1]
+
+    def run(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
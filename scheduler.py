@@ -0,0 +1,255 @@
+import time
+import collections
+
+BROADCAST = 255
+
+
+class InFlight(object):
+    __slots__ = ('packet', 'sent', 'again', 'timer', 'timeout', 'delay')
+
+    def __init__(self, packet, sent, timeout, delay):
+        self.packet = packet
+        self.sent = sent
+        self.again = 0
+        self.timer = None
+        self.timeout = timeout
+        self.delay = delay
+
+
+class PacketScheduler(object):
+    """ One outstanding packet per node, up to `window` nodes waiting for an ACK at the same time.
+
+    write(packet, again) puts a packet on the bus, expired(packet) is called when a packet
+    is dropped after `timeout` seconds, busy() tells if incoming bytes are waiting to be parsed.
+    health (a liveness.Liveness) adapts retry delay and timeout to every node and holds back the
+    packets of the nodes that are down (drops them when defer is False), for hold seconds at most
+    when given: older packets go to expired() like the unanswered ones. probe(dest) builds the
+    packet that checks if a down node is back, owns(dest) tells the nodes it may probe (all by default).
+    coalesce(packet) returns the key of a packet that sets a state (None for the others): a newer
+    packet with the same key replaces the unsent one of its node, an identical one is dropped.
+    Every packet spared adds cost seconds, the bus time of a send and its ACK, to saved.
+    frame is the time of a packet on the wire, given for a half duplex bus: after every send (retries
+    included) the line is left to the reply slot of that node, the packet, its ACK and the node latency,
+    before anything else is sent. The window then only lets other nodes go while a node waits for a retry.
+    """
+
+    def __init__(self, timers, write, expired=None, busy=None,
+                 window=4, timeout=0.5, retry_delay=0.03, spacing=0, health=None, probe=None, defer=True,
+                 coalesce=None, cost=0.0, owns=None, frame=None, hold=None):
+        self.timers = timers
+        self.write = write
+        self.expired = expired
+        self.busy = busy
+        self.window = window
+        self.timeout = timeout
+        self.retry_delay = retry_delay
+        self.spacing = spacing
+        # dest: deque of (time queued, packet)
+        self.pending = collections.OrderedDict()
+        self.inflight = dict()
+        self.send_after = 0
+        self.frame = frame
+        # End of the reply slot of the last send, and its in flight entry
+        self.line_free = 0.0
+        self.line_entry = None
+        self.pump_timer = None
+        self.health = health
+        self.probe = probe
+        self.defer = defer
+        self.hold = hold
+        self.hold_timer = None
+        self.probe_timer = None
+        self.owns = owns
+        self.coalesce = coalesce
+        self.cost = cost
+        self.counters = collections.Counter()
+        self.saved = 0.0
+
+    def __len__(self):
+        return sum(len(q) for q in self.pending.values()) + len(self.inflight)
+
+    def submit(self, packet):
+        queue = self.pending.get(packet.dest)
+        key = self.coalesce(packet) if self.coalesce else None
+        if key is not None and self._merge(queue or (), packet, key):
+            return
+        if queue is None:
+            queue = self.pending[packet.dest] = collections.deque()
+        queue.append((time.monotonic(), packet))
+
+    def _merge(self, queue, packet, key):
+        """ Put packet in place of the unsent one with the same key, True when it needs no slot of its own"""
+        for i in range(len(queue) - 1, -1, -1):
+            queued = queue[i][1]
+            queued_key = self.coalesce(queued)
+            if queued_key is None:
+                # Don't move a state past a command that could depend on it (e.g. LCDCLEAR)
+                return False
+            if queued_key == key:
+                if queued.data == packet.data:
+                    self._spared('duplicates')
+                else:
+                    queue[i] = (time.monotonic(), packet)
+                    self._spared('coalesced')
+                return True
+        # Not against the packet in flight: if it expires, the newer one must still go
+        return False
+
+    def _spared(self, reason):
+        self.counters[reason] += 1
+        self.saved += self.cost
+
+    def extend(self, packets):
+        for packet in packets:
+            self.submit(packet)
+
+    def acknowledge(self, source, command):
+        """ Return the in flight packet answered by this frame, None if the frame is a new message"""
+        entry = self.inflight.get(source)
+        if entry is None or entry.packet.data[0] != command:
+            # A broadcast is closed by the first frame received, as the single-packet loop did
+            entry = self.inflight.get(BROADCAST)
+            if entry is None:
+                return None
+        self._done(entry)
+        if self.health and entry.packet.dest != BROADCAST:
+            if entry.again:
+                # The ACK could answer any of the sends, don't use it as a latency sample
+                self.health.seen(source)
+            else:
+                self.health.acked(source, time.monotonic() - entry.sent)
+        return entry.packet
+
+    def pump(self):
+        """ Send the head of every idle node queue while the window has room"""
+        # A broadcast must not overlap unicast traffic, its reply could come from anyone
+        if not self.pending or len(self.inflight) >= self.window or BROADCAST in self.inflight:
+            return
+        wait = max(self.send_after - time.monotonic() if self.spacing else 0, self._line_wait())
+        if wait > 0:
+            if not self.pump_timer:
+                self.pump_timer = self.timers.schedule(wait, self._pump_timer)
+            return
+        held = False
+        for dest in list(self.pending):
+            if dest in self.inflight or (dest == BROADCAST and self.inflight):
+                continue
+            if self.health and dest != BROADCAST and not self.health.allow(dest):
+                if not self.defer:
+                    for _, packet in self.pending.pop(dest):
+                        if self.expired:
+                            self.expired(packet)
+                held = True
+                continue
+            queue = self.pending[dest]
+            _, packet = queue.popleft()
+            if queue:
+                self.pending.move_to_end(dest)
+            else:
+                del self.pending[dest]
+            self._send(packet)
+            if self.spacing or self.frame is not None or dest == BROADCAST or len(self.inflight) >= self.window:
+                break
+        if held and self.defer and self.hold is not None and self.hold_timer is None:
+            self._expire_held()
+
+    def _expire_held(self):
+        """ Drop the packets held for a down node more than hold seconds, wake up for the next one"""
+        self.hold_timer = None
+        now = time.monotonic()
+        due = None
+        for dest in list(self.pending):
+            if dest == BROADCAST or self.health.allow(dest):
+                continue
+            queue = self.pending[dest]
+            while queue and now - queue[0][0] >= self.hold:
+                _, packet = queue.popleft()
+                self.counters['held expired'] += 1
+                if self.expired:
+                    self.expired(packet)
+            if not queue:
+                del self.pending[dest]
+            elif due is None or queue[0][0] < due:
+                due = queue[0][0]
+        if due is not None:
+            self.hold_timer = self.timers.schedule(due + self.hold - now, self._expire_held)
+
+    def _send(self, packet):
+        timeout, delay = self.timeout, self.retry_delay
+        if self.health and packet.dest != BROADCAST:
+            delay = self.health.retry_delay(packet.dest, self.retry_delay)
+            timeout = self.health.timeout(packet.dest, self.timeout, self.retry_delay)
+        entry = InFlight(packet, time.monotonic(), timeout, delay)
+        self.inflight[packet.dest] = entry
+        self._occupy(entry)
+        self.write(packet, 0)
+        entry.timer = self.timers.schedule(delay, self._retry, entry)
+
+    def _reply_slot(self, dest):
+        """ Line time of a send to dest: the packet, the node latency and its ACK"""
+        latency = self.health.retry_delay(dest, 0.0) if self.health and dest != BROADCAST else 0.0
+        return 2 * self.frame + (latency or self.retry_delay)
+
+    def _occupy(self, entry):
+        if self.frame is not None:
+            self.line_free = time.monotonic() + self._reply_slot(entry.packet.dest)
+            self.line_entry = entry
+
+    def _line_wait(self):
+        """ Seconds before the line is free for a send"""
+        return self.line_free - time.monotonic() if self.frame is not None else 0
+
+    def _arm_probe(self):
+        if self.probe is None or self.probe_timer is not None:
+            return
+        delay = self.health.next_probe(self.owns)
+        if delay is not None:
+            self.probe_timer = self.timers.schedule(delay, self._probe_timer)
+
+    def _probe_timer(self):
+        self.probe_timer = None
+        for dest in self.health.probes(accept=self.owns):
+            if dest in self.inflight or BROADCAST in self.inflight or len(self.inflight) >= self.window or \
+                    self._line_wait() > 0:
+                continue
+            self._send(self.probe(dest))
+        self._arm_probe()
+
+    def _pump_timer(self):
+        self.pump_timer = None
+        self.pump()
+
+    def _done(self, entry):
+        if entry.timer:
+            entry.timer.cancel()
+            entry.timer = None
+        del self.inflight[entry.packet.dest]
+        if entry is self.line_entry:
+            # ACK received or given up: nothing more is coming on the line
+            self.line_free = 0.0
+            self.line_entry = None
+        self.send_after = time.monotonic() + self.spacing
+
+    def _retry(self, entry):
+        entry.timer = None
+        if time.monotonic() - entry.sent >= entry.timeout:
+            self._done(entry)
+            if self.health and entry.packet.dest != BROADCAST:
+                self.health.failed(entry.packet.dest)
+                self._arm_probe()
+            if self.expired:
+                self.expired(entry.packet)
+            self.pump()
+            return
+        wait = self._line_wait()
+        if wait > 0:
+            # The reply slot of another node is open
+            entry.timer = self.timers.schedule(wait, self._retry, entry)
+            return
+        entry.timer = self.timers.schedule(entry.delay, self._retry, entry)
+        if self.busy and self.busy():
+            # The reply could be already there, parse it before sending again
+            return
+        entry.again += 1
+        self._occupy(entry)
+        self.write(entry.packet, entry.again)
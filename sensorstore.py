@@ -0,0 +1,172 @@
+""" Append-only store of the sensor values reported by the nodes.
+
+Every node and metric has a file of fixed width records (time, value) per segment of time:
+
+    {root}/{node}/{metric}-{segment start}.dat
+
+Records are appended in time order, so the records of a range are found with a binary search.
+add() only queues the value: a writer thread appends the batches, so the bus threads never wait
+for the disk.
+"""
+import os
+import time
+import queue
+import struct
+import logging
+import threading
+from collections import OrderedDict
+
+LOGGER = logging.getLogger(__name__)
+
+RECORD = struct.Struct("<df")  # time.time(), value
+MINUTE = 60
+HOUR = 3600
+DAY = 86400
+MAX_OPEN = 64  # segment files kept open by the writer
+# Values stored for each message: {message: (field of the parsed value, metric)}
+SENSORS = {
+    "MEM": (('value', 'mem'),),
+    "DHT": (('temperature', 'temperature'), ('humidity', 'humidity')),
+    "PIR": (('value', 'pir'),),
+    "LUX": (('value', 'lux'),),
+}
+
+
+def _search(data, t):
+    """ Index of the first record of data with time >= t"""
+    lo, hi = 0, len(data) // RECORD.size
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if RECORD.unpack_from(data, mid * RECORD.size)[0] < t:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+class SensorStore(object):
+    def __init__(self, root, segment=DAY, max_open=MAX_OPEN):
+        self.root = root
+        self.segment = segment
+        self.max_open = max_open
+        self.files = OrderedDict()
+        self.queue = queue.SimpleQueue()
+        self.written = 0
+        self.thread = threading.Thread(target=self._run, name="SensorStore", daemon=True)
+        self.thread.start()
+
+    def add(self, node, metric, value, t=None):
+        self.queue.put((t if t is not None else time.time(), node, metric, value))
+
+    def flush(self, timeout=None):
+        """ Wait until the values added so far are on disk"""
+        done = threading.Event()
+        self.queue.put(done)
+        return done.wait(timeout)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def path(self, node, metric, start):
+        return os.path.join(self.root, str(node), f"{metric}-{int(start)}.dat")
+
+    def _file(self, path):
+        f = self.files.pop(path, None)
+        if f is None:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            f = open(path, "ab")
+            if len(self.files) >= self.max_open:
+                # The least recently written segment, usually one of the previous period
+                self.files.popitem(last=False)[1].close()
+        self.files[path] = f
+        return f
+
+    def _write(self, records):
+        batches = dict()
+        for t, node, metric, value in records:
+            path = self.path(node, metric, t // self.segment * self.segment)
+            batches.setdefault(path, bytearray()).extend(RECORD.pack(t, value))
+        for path, data in batches.items():
+            f = self._file(path)
+            f.write(data)
+            f.flush()
+        self.written += len(records)
+
+    def _run(self):
+        while True:
+            items = [self.queue.get()]
+            try:
+                while True:
+                    items.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            records = list()
+            for item in items:
+                if isinstance(item, tuple):
+                    records.append(item)
+                    continue
+                try:
+                    self._write(records)
+                except OSError as e:
+                    LOGGER.error(f"Sensor store: {e}")
+                records = list()
+                if item is None:
+                    for f in self.files.values():
+                        f.close()
+                    self.files.clear()
+                    return
+                item.set()
+            try:
+                self._write(records)
+            except OSError as e:
+                LOGGER.error(f"Sensor store: {e}")
+
+    def query(self, node, metric, start, end):
+        """ [(time, value), ...] of node and metric with start <= time < end"""
+        result = list()
+        for segment in self.segments(node, metric):
+            if segment + self.segment <= start or segment >= end:
+                continue
+            with open(self.path(node, metric, segment), "rb") as f:
+                data = f.read()
+            # A record being written can be incomplete
+            data = memoryview(data)[:len(data) // RECORD.size * RECORD.size]
+            first, last = _search(data, start), _search(data, end)
+            result.extend(RECORD.iter_unpack(data[first * RECORD.size:last * RECORD.size]))
+        return result
+
+    def segments(self, node, metric):
+        """ Start times of the segments of node and metric, in order"""
+        try:
+            names = os.listdir(os.path.join(self.root, str(node)))
+        except FileNotFoundError:
+            return []
+        prefix = f"{metric}-"
+        return sorted(int(name[len(prefix):-4]) for name in names if name.startswith(prefix) and name.endswith(".dat"))
+
+    def rollup(self, node, metric, start, end, period=MINUTE):
+        """ [(period start, min, max, avg, count), ...] of the periods with values"""
+        result = list()
+        bucket = None
+        for t, value in self.query(node, metric, start, end):
+            key = t // period * period
+            if bucket is None or bucket[0] != key:
+                if bucket is not None:
+                    result.append((bucket[0], bucket[1], bucket[2], bucket[3] / bucket[4], bucket[4]))
+                bucket = [key, value, value, 0.0, 0]
+            bucket[1] = min(bucket[1], value)
+            bucket[2] = max(bucket[2], value)
+            bucket[3] += value
+            bucket[4] += 1
+        if bucket is not None:
+            result.append((bucket[0], bucket[1], bucket[2], bucket[3] / bucket[4], bucket[4]))
+        return result
+
+    def metrics(self, node):
+        """ Metrics stored for node"""
+        try:
+            names = os.listdir(os.path.join(self.root, str(node)))
+        except FileNotFoundError:
+            return []
+        return sorted({name.rsplit("-", 1)[0] for name in names if name.endswith(".dat")})
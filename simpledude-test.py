@@ -0,0 +1,487 @@
+import os
+import time
+import serial
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import simpledude
+import stk500sim
+import fleet
+import multi_serial_port
+from framing import FrameDecoder
+
+HEX = """:020000040001F9
+:0400000001020304F2
+:00000001FF
+"""
+
+
+def write_hex(path, image):
+    with open(path, "w") as f:
+        for address in range(0, len(image), 16):
+            record = bytes([16, address // 256, address % 256, 0]) + image[address:address + 16]
+            f.write(f":{record.hex().upper()}{-sum(record) & 0xFF:02X}\n")
+        f.write(":00000001FF\n")
+
+
+class TestHexFile(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".hex")
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def write(self, text):
+        with open(self.path, "w") as f:
+            f.write(text)
+
+    def test_pages(self):
+        image = simpledude.load_hex(os.path.join(os.path.dirname(__file__) or ".", "domuino_old.hex"))
+        self.assertEqual(len(image), 0x2A3A)
+        self.assertEqual(image.pages[0][:4], b'\x0c\x94\xcd\x02')
+        self.assertTrue(all(len(p) == simpledude.PAGE_SIZE for p in image.pages[:-1]))
+        self.assertEqual(b''.join(image.pages), image.image)
+
+    def test_extended_address(self):
+        self.write(HEX)
+        image = simpledude.parse_hex(self.path)
+        self.assertEqual(len(image), 0x10004)
+        self.assertEqual(image.image[-4:], b'\x01\x02\x03\x04')
+        self.assertEqual(image.image[0], 0xFF)
+
+    def test_erased_tail(self):
+        self.write(":0400000001020304F2\n:0400FC00FFFFFFFF04\n:00000001FF\n")
+        image = simpledude.parse_hex(self.path)
+        self.assertEqual(len(image), 256)
+        self.assertEqual(len(image.pages), 1)
+
+    def test_checksum(self):
+        self.write(":0400000001020304F3\n")
+        self.assertRaises(ValueError, simpledude.parse_hex, self.path)
+
+    def test_cache(self):
+        self.write(":0400000001020304F2\n:00000001FF\n")
+        image = simpledude.load_hex(self.path)
+        self.assertIs(simpledude.load_hex(self.path), image)
+        self.write(":0400000001020305F1\n:00000001FF\n")
+        os.utime(self.path, ns=(0, 1))
+        self.assertEqual(simpledude.load_hex(self.path).image, b'\x01\x02\x03\x05')
+
+
+class Bootloader(object):
+    """ Port answering STK_GET_SYNC only at the rate the bootloader was built with"""
+
+    def __init__(self, baudrate):
+        self.built = baudrate
+        self.baudrate = simpledude.BAUD_RATE
+        self.timeout = 0.1
+        self.out = bytearray()
+
+    def write(self, data):
+        if self.baudrate == self.built and bytes(data) == bytes(simpledude.SYNC):
+            self.out += bytes(simpledude.INSINK)
+
+    def read(self, size=1):
+        reply = bytes(self.out[:size])
+        del self.out[:size]
+        return reply
+
+    def reset_input_buffer(self):
+        self.out.clear()
+
+
+class TestNegotiate(unittest.TestCase):
+    def test_fastest(self):
+        port = Bootloader(57600)
+        dude = simpledude.SimpleDude(port, mode485=True)
+        self.assertEqual(dude.negotiate(57600, timeout=0.01), 57600)
+        self.assertEqual(dude.boot_baudrate, 57600)
+        dude.restore_baudrate()
+        self.assertEqual(port.baudrate, simpledude.BAUD_RATE)
+
+    def test_sync_lost(self):
+        class Silent(stk500sim.Optiboot):
+            """ Target that stops answering for a while"""
+            silent = 0
+
+            def _send(self, reply, received):
+                if self.silent:
+                    self.silent -= 1
+                    return
+                super()._send(reply, received)
+
+        target = Silent(boot_baudrate=115200)
+        dude = simpledude.SimpleDude(target, retry=1)
+        self.assertEqual(dude.negotiate(115200, timeout=0.01), 115200)
+        # Retries and resyncs fail: the bootloader is probed again at its own rate only
+        target.silent = 2 + simpledude.RESYNC_TRIES
+        with self.assertLogs("simpledude", "WARNING") as logs:
+            self.assertEqual(dude.spi_transaction(simpledude.GET_SN_MINOR, 1), 1)
+        self.assertIn("WARNING:simpledude:Sync lost, probing 115200 baud again", logs.output)
+        self.assertEqual((target.baudrate, target.resets), (115200, 0))
+        target.silent = 100
+        self.assertRaises(Exception, dude.spi_transaction, simpledude.GET_SN_MINOR, 1)
+        self.assertEqual((target.baudrate, target.resets), (115200, 0))
+
+    def test_recorded_rate(self):
+        target = stk500sim.Optiboot(boot_baudrate=115200)
+        self.assertEqual(simpledude.SimpleDude(target).negotiate(115200, timeout=0.01), 115200)
+        self.assertEqual(target.resets, 0)
+        path = os.path.join(tempfile.mkdtemp(), "bootloaders.json")
+        simpledude.record_boot_baudrate(36097, 115200, path)
+        self.assertEqual(simpledude.boot_baudrate(36097, path), 115200)
+        self.assertIsNone(simpledude.boot_baudrate(11, path))
+        shutil.rmtree(os.path.dirname(path))
+
+    def test_base_rate_first(self):
+        target = stk500sim.Optiboot(boot_baudrate=simpledude.BAUD_RATE)
+        self.assertEqual(simpledude.SimpleDude(target).negotiate(timeout=0.01), simpledude.BAUD_RATE)
+        self.assertEqual(target.resets, 0)
+
+    def test_wrong_rate_resets(self):
+        # A blind probe at the port rate sends the node to its application before its rate is tried
+        target = stk500sim.Optiboot(boot_baudrate=115200)
+        self.assertEqual(simpledude.SimpleDude(target).negotiate(timeout=0.01), simpledude.BAUD_RATE)
+        self.assertFalse(target.in_bootloader)
+
+    def test_no_answer(self):
+        port = Bootloader(None)
+        dude = simpledude.SimpleDude(port)
+        self.assertEqual(dude.negotiate(timeout=0.01), simpledude.BAUD_RATE)
+        self.assertEqual(port.baudrate, simpledude.BAUD_RATE)
+
+
+class Late(stk500sim.Optiboot):
+    """ Target answering one command late, counting the timeouts set on the port"""
+
+    def __init__(self, late, delay, **kwargs):
+        self.timeouts = 0
+        super().__init__(**kwargs)
+        self.late = late
+        self.delay = delay
+
+    @property
+    def timeout(self):
+        return self._timeout
+
+    @timeout.setter
+    def timeout(self, timeout):
+        self.timeouts += 1
+        self._timeout = timeout
+
+    def _send(self, reply, received):
+        self.late -= 1
+        super()._send(reply, received + (self.delay if self.late == 0 else 0.0))
+
+
+class TestTimeout(unittest.TestCase):
+    def test_measure(self):
+        dude = simpledude.SimpleDude(stk500sim.Optiboot())
+        dude._measure("key", 0.02)
+        self.assertEqual(dude.latency["key"], (0.02, 0.01))
+        dude._measure("key", 0.04)
+        srtt, rttvar = dude.latency["key"]
+        self.assertAlmostEqual(srtt, 0.875 * 0.02 + 0.125 * 0.04)
+        self.assertAlmostEqual(rttvar, 0.75 * 0.01 + 0.25 * 0.02)
+
+    def test_reply_timeout(self):
+        target = stk500sim.Optiboot()
+        target.baudrate = 115200
+        dude = simpledude.SimpleDude(target)
+        floor = simpledude.TIMEOUT_FRAMES * dude.frame_time()
+        self.assertGreaterEqual(dude.reply_timeout("key", 2), simpledude.INITIAL_LATENCY)
+        dude._measure("key", 0.0001)
+        self.assertGreaterEqual(dude.reply_timeout("key", 2), floor)
+        self.assertLess(dude.reply_timeout("key", 2), floor + simpledude.TIMEOUT_STEP)
+        self.assertGreaterEqual(dude.reply_timeout("key", 2, attempt=1), 2 * floor)
+        self.assertEqual(dude.reply_timeout("key", 2, attempt=10), simpledude.MAX_TIMEOUT)
+        # The floor scales with the baud rate
+        target.baudrate = 38400
+        self.assertGreater(dude.reply_timeout("key", 2), floor * 2)
+
+    def test_late_reply(self):
+        dir = tempfile.mkdtemp()
+        path = os.path.join(dir, "image.hex")
+        write_hex(path, bytes(range(128)) * 20)
+        image = simpledude.load_hex(path).image
+        # The 30th command is the readback of a page in the middle of the session
+        target = Late(30, 0.3, flash=image + b'\xff' * (stk500sim.FLASH_SIZE - len(image)))
+        target.timeout = 1
+        dude = simpledude.SimpleDude(target, hexfile=path)
+        self.assertTrue(dude.verify())
+        self.assertGreater(dude.retries, 0)
+        self.assertLess(dude.retries, 3)
+        self.assertTrue(dude.program(differential=True))
+        self.assertEqual(target.commands[simpledude.STK_PROG_PAGE], 0)
+        # The port gets its timeout back, and it is not set at every exchange
+        self.assertEqual(target.timeout, 1)
+        self.assertLess(target.timeouts, 20)
+        shutil.rmtree(dir)
+
+
+class TestCompression(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".hex")
+        os.close(fd)
+        # page 0 code, page 1 zeros, page 2 erased, page 3 copy of page 0, page 4 code
+        code = bytes(range(128))
+        self.image = code + bytes(128) + b'\xff' * 128 + code + code[::-1]
+        write_hex(self.path, self.image)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def program(self, target):
+        target.flash[:len(self.image)] = b'\x55' * len(self.image)
+        dude = simpledude.SimpleDude(target, hexfile=self.path)
+        self.assertTrue(dude.program(verify=True, compress=True))
+        self.assertEqual(target.flash[:len(self.image)], self.image)
+        self.assertEqual((target.overruns, dude.retries), (0, 0))
+
+    def test_compressed(self):
+        target = stk500sim.Optiboot(compression=True)
+        self.program(target)
+        self.assertEqual(target.commands[simpledude.CSTM_PROG_FILL], 2)
+        self.assertEqual(target.commands[simpledude.CSTM_PROG_COPY], 1)
+        self.assertEqual(target.commands[simpledude.STK_PROG_PAGE], 2)
+
+    def test_stock_bootloader(self):
+        target = stk500sim.Optiboot()
+        self.program(target)
+        self.assertEqual(target.commands[simpledude.STK_PROG_PAGE], 5)
+
+
+class TestManifest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.manifest = os.path.join(self.dir, "manifest.json")
+        self.v1, self.v2 = os.path.join(self.dir, "v1.hex"), os.path.join(self.dir, "v2.hex")
+        write_hex(self.v1, bytes(range(128)) * 4)
+        write_hex(self.v2, bytes(range(128))[::-1] * 4)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_stale_entry(self):
+        target = stk500sim.Optiboot(serial_number=258)
+        self.assertTrue(simpledude.SimpleDude(target, hexfile=self.v2).program(manifest=self.manifest))
+        # Flashed by a tool that doesn't know the manifest
+        self.assertTrue(simpledude.SimpleDude(target, hexfile=self.v1).program())
+        dude = simpledude.SimpleDude(target, hexfile=self.v2)
+        self.assertTrue(dude.program(differential=True, manifest=self.manifest, verify=True))
+        self.assertEqual(bytes(target.flash[:512]), simpledude.load_hex(self.v2).image)
+
+    def test_default_manifest(self):
+        target = stk500sim.Optiboot(serial_number=258)
+        simpledude.SimpleDude(target, hexfile=self.v2, manifest=self.manifest).program()
+        self.assertEqual(simpledude.load_manifest(self.manifest)["258"], simpledude.load_hex(self.v2).digests())
+
+    def test_stock_serial_number(self):
+        target = stk500sim.Optiboot(serial_number=simpledude.STOCK_SERIAL_NUMBER)
+        simpledude.SimpleDude(target, hexfile=self.v2).program(manifest=self.manifest)
+        self.assertEqual(simpledude.load_manifest(self.manifest), {})
+
+
+class TestSimulator(unittest.TestCase):
+    def test_throttle(self):
+        target = stk500sim.Optiboot(throttle=True, latency=0.01)
+        target.baudrate = 115200
+        dude = simpledude.SimpleDude(target)
+        start = time.monotonic()
+        dude.spi_batch([(simpledude.SYNC, 0)] * 10)
+        # 20 bytes of commands, the latency and the 2 bytes of the last reply (full duplex)
+        self.assertGreaterEqual(time.monotonic() - start, 22 * 10 / 115200 + 0.01)
+
+    def test_bit_errors(self):
+        target = stk500sim.Optiboot(error_rate=1.0, seed=0)
+        dude = simpledude.SimpleDude(target, retry=1)
+        self.assertRaises(Exception, dude.spi_transaction, simpledude.SYNC)
+        self.assertGreater(target.errors, 0)
+
+    def test_page_write_overrun(self):
+        target = stk500sim.Optiboot()
+        page = bytes(simpledude.PAGE_SIZE)
+        target.write(bytes(simpledude.SimpleDude._load_address(0)) + simpledude.SimpleDude._prog_page(page) +
+                     bytes(simpledude.SimpleDude._load_address(0)) + bytes(simpledude.SimpleDude._read_page(len(page))))
+        self.assertEqual(target.overruns, 6)
+
+    def test_batch_retry(self):
+        class Corrupt(stk500sim.Optiboot):
+            """ Target sending a bad STK_OK in its reply to the `count`th `code` command"""
+
+            def __init__(self, code, count, **kwargs):
+                super().__init__(**kwargs)
+                self.code = code
+                self.count = count
+                self.log = list()
+
+            def _command(self, received):
+                if len(self.request) == self._length(self.request) and self.request[0] != simpledude.STK_GET_SYNC:
+                    self.log.append(self.request[0])
+                return super()._command(received)
+
+            def _send(self, reply, received):
+                if self.log and self.log[-1] == self.code and self.log.count(self.code) == self.count:
+                    self.count = 0
+                    reply = reply[:-1] + b'\x00'
+                super()._send(reply, received)
+
+        load, read = simpledude.STK_LOAD_ADDRESS, simpledude.STK_READ_PAGE
+        image = bytes(range(256))
+        target = Corrupt(read, 2, flash=image + b'\xff' * (stk500sim.FLASH_SIZE - len(image)))
+        dude = simpledude.SimpleDude(target)
+        commands = [(dude._load_address(0), 0), (dude._read_page(128), 128),
+                    (dude._load_address(64), 0), (dude._read_page(128), 128)]
+        results = dude.spi_batch(commands)
+        # Retried from the failed read, backing up to its address
+        self.assertEqual(target.log, [load, read, load, read, load, read])
+        self.assertEqual(b"".join(bytes(r) for r in results[1::2]), image)
+        self.assertEqual(dude.retries, 1)
+
+        path = os.path.join(tempfile.mkdtemp(), "image.hex")
+        write_hex(path, image * 4)
+        target = Corrupt(simpledude.STK_PROG_PAGE, 3)
+        dude = simpledude.SimpleDude(target, hexfile=path)
+        self.assertTrue(dude.program())
+        self.assertEqual(target.commands[simpledude.STK_PROG_PAGE], 9)
+        self.assertEqual(bytes(target.flash[:len(image) * 4]), image * 4)
+        shutil.rmtree(os.path.dirname(path))
+
+    def test_verify_rewrite(self):
+        class Flaky(stk500sim.Optiboot):
+            flips = 1
+
+            def program_page(self, data):
+                if self.flips:
+                    self.flips -= 1
+                    data = bytes([data[0] ^ 1]) + data[1:]
+                super().program_page(data)
+
+        path = os.path.join(tempfile.mkdtemp(), "image.hex")
+        write_hex(path, bytes(range(128)) * 2)
+        dude = simpledude.SimpleDude(Flaky(), hexfile=path)
+        self.assertTrue(dude.program(verify=True))
+        self.assertEqual(dude.rewrites, 1)
+        target = Flaky()
+        target.flips = simpledude.VERIFY_REWRITES + 1
+        dude = simpledude.SimpleDude(target, hexfile=path)
+        self.assertFalse(dude.program(verify=True))
+        self.assertEqual((dude.failed_page, dude.rewrites), (0, simpledude.VERIFY_REWRITES))
+        shutil.rmtree(os.path.dirname(path))
+
+    def test_pty(self):
+        server = stk500sim.PtyServer(stk500sim.Optiboot(serial_number=258))
+        server.start()
+        port = serial.Serial(server.port, timeout=1)
+        try:
+            self.assertEqual(simpledude.SimpleDude(port).serial_number(), 258)
+        finally:
+            port.close()
+            server.stop()
+
+
+
+class Node(stk500sim.Optiboot):
+    """ Domuino node: the application answers PING and starts the bootloader on PROGRAM (when it boots)"""
+
+    def __init__(self, net, boots=True, **kwargs):
+        super().__init__(**kwargs)
+        self.net = net
+        self.boots = boots
+        self.in_bootloader = False
+        self.decoder = FrameDecoder(multi_serial_port.PACKET_HEADER, multi_serial_port.MAX_PACKET_SIZE,
+                                    check=multi_serial_port.valid_frame)
+
+    def write(self, data):
+        if self.in_bootloader:
+            return super().write(data)
+        for body in self.decoder.decode(bytes(data)):
+            packet = multi_serial_port.Packet.from_buffer(body)
+            if packet.dest != self.net:
+                continue
+            if packet.data[0] == multi_serial_port.QUERIES["PING"]:
+                reply = multi_serial_port.Packet(packet.data[:1], source=self.net, dest=multi_serial_port.NODE_ID)
+                self._send(reply.serialize(), time.monotonic())
+            elif packet.data[0] == multi_serial_port.QUERIES["PROGRAM"] and self.boots:
+                self.start_bootloader()
+        return len(data)
+
+
+class TestFleet(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.hexfile = os.path.join(self.dir, "domuino.hex")
+        write_hex(self.hexfile, bytes(range(128)) * 3)
+        self.image = simpledude.load_hex(self.hexfile)
+        self.state = os.path.join(self.dir, "fleet-state.json")
+        patches = [mock.patch.object(fleet, "FLASH_MANIFEST", os.path.join(self.dir, "manifest.json")),
+                   mock.patch.object(fleet, "boot_baudrate", return_value=None),
+                   mock.patch.object(fleet, "BOOT_TIMEOUT", 0.2)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_state(self):
+        state = fleet.FleetState(self.state, self.image)
+        state.update(60, {'status': "OK"})
+        state.update(61, {'status': "FAILED"})
+        state = fleet.FleetState(self.state, self.image)
+        self.assertEqual((state.done(60), state.done(61), state.done(62)), (True, False, False))
+        self.assertFalse(fleet.FleetState(self.state, self.image, restart=True).done(60))
+        write_hex(self.hexfile, bytes(range(128))[::-1] * 3)
+        os.utime(self.hexfile, ns=(0, 1))
+        self.assertEqual(fleet.FleetState(self.state, simpledude.load_hex(self.hexfile)).nodes, {})
+
+    def test_assign(self):
+        ports = [Node(60), Node(61)]
+        for i, port in enumerate(ports):
+            port.name = f"bus{i}"
+        with mock.patch.dict(fleet.config, {"SA-7": dict(fleet.config["SA-7"], bus="bus1")}):
+            buses = fleet.assign([("SA-2", 60), ("SA-3", 61), ("SA-7", 62), ("SA-10M", 63)], ports)
+        # SA-7 goes where its bus: key says, SA-10M answers nowhere
+        self.assertEqual(buses, {ports[0]: [("SA-2", 60)], ports[1]: [("SA-3", 61), ("SA-7", 62)]})
+        self.assertIs(fleet.locate(61, ports), ports[1])
+        self.assertIsNone(fleet.locate(63, ports))
+
+    def test_update_node(self):
+        node = Node(60)
+        report = fleet.update_node(node, "SA-2", 60, self.hexfile, differential=True)
+        self.assertEqual((report['status'], report['bytes']), ("OK", len(self.image)))
+        self.assertEqual(bytes(node.flash[:len(self.image)]), self.image.image)
+        report = fleet.update_node(Node(61, boots=False), "SA-3", 61, self.hexfile, differential=True)
+        self.assertEqual((report['status'], report['bytes']), ("NO BOOTLOADER", 0))
+
+    def test_update_fleet(self):
+        nodes = [Node(60, serial_number=60), Node(61, serial_number=61), Node(62, boots=False)]
+        servers = [stk500sim.PtyServer(nodes[0]), stk500sim.PtyServer(nodes[1]), stk500sim.PtyServer(nodes[2])]
+        for server in servers:
+            server.start()
+        try:
+            state = fleet.update_fleet(self.hexfile, com_ports=[server.port for server in servers],
+                                       nets=[60, 61, 62], state_file=self.state)
+            self.assertEqual({net: report['status'] for net, report in state.nodes.items()},
+                             {60: "OK", 61: "OK", 62: "NO BOOTLOADER"})
+            for node in nodes[:2]:
+                self.assertEqual(bytes(node.flash[:len(self.image)]), self.image.image)
+            # Both buses saved their node in the manifest
+            self.assertEqual(sorted(simpledude.load_manifest(fleet.FLASH_MANIFEST)), ["60", "61"])
+            # The nodes already done are not flashed again
+            for node in nodes:
+                node.commands.clear()
+                node.in_bootloader = False
+            state = fleet.update_fleet(self.hexfile, com_ports=[server.port for server in servers],
+                                       nets=[60, 61, 62], state_file=self.state)
+            self.assertEqual(sum(node.commands[simpledude.STK_GET_SYNC] for node in nodes[:2]), 0)
+            self.assertEqual(state.nodes[62]['status'], "NO BOOTLOADER")
+        finally:
+            for server in servers:
+                server.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
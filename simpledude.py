@@ -1,7 +1,14 @@
 #!/usr/bin/python
 
 # import libraries
+import functools
+import hashlib
+import json
+import math
 import logging
+import os
+import random
+import threading
 import time
 #from oauthlib.oauth2.rfc6749.parameters import prepare_grant_uri
 from serial import rs485
@@ -50,6 +57,9 @@ STK_SW_MAJOR = 0x81  # ' '
 STK_SW_MINOR = 0x82  # ' '
 CSTM_SN_MAJOR = 0x92  # Custom for serial number
 CSTM_SN_MINOR = 0x93  # Custom for serial number
+CSTM_COMPRESSION = 0x94  # Custom, compressed transfer capabilities: COMPRESSION_MAGIC | COMPRESSION_*
+CSTM_PROG_FILL = 0x66  # 'f' Custom, fill the page with one byte
+CSTM_PROG_COPY = 0x67  # 'g' Custom, copy the page at a word address
 
 
 SYNC = [STK_GET_SYNC, CRC_EOP]
@@ -65,17 +75,187 @@ GET_SAFE_LFUSE = [STK_UNIVERSAL, 0x50, 0x00, 0x00, 0x00, CRC_EOP]
 GET_SAFE_HFUSE = [STK_UNIVERSAL, 0x58, 0x08, 0x00, 0x00, CRC_EOP]
 GET_SAFE_EFUSE = [STK_UNIVERSAL, 0x50, 0x08, 0x00, 0x00, CRC_EOP]
 GET_SIGNATURE = [STK_READ_SIGN, CRC_EOP]
+GET_COMPRESSION = [STK_GET_PARAMETER, CSTM_COMPRESSION, CRC_EOP]
 INSINK = [STK_INSYNC, STK_OK]
 
+PAGE_SIZE = 128  # bytes, flash page of the ATmega168
+FLASH_MANIFEST = os.path.join(os.path.dirname(os.path.abspath(__file__)), "flash-manifest.json")
+# Stock optiboot answers 0x03 to the serial number parameters: every such node would share one manifest entry
+STOCK_SERIAL_NUMBER = 0x0303
+# Stock optiboot answers 0x03 to unknown parameters, the magic tells a compression build apart
+COMPRESSION_MAGIC = 0xC0
+COMPRESSION_FILL = 0x01
+COMPRESSION_COPY = 0x02
+BAUD_RATE = 38400
+# Rates a bootloader can be built with. It answers only at its own rate, and optiboot resets into the
+# application at the first byte it can't parse: a rate that is not the node's one is probed as a last resort
+BAUD_RATES = (115200, 76800, 57600, BAUD_RATE)
+# Rate of the bootloader of every node, written by flash_bootloader(): {net: baudrate}
+BOOTLOADERS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bootloaders.json")
+
+# Reply timeout = time on the wire + bootloader latency (estimated from the replies, RFC 6298 style)
+INITIAL_LATENCY = 0.2  # s, until the first reply is measured
+MIN_LATENCY = 0.005  # s
+MAX_TIMEOUT = 2.0  # s
+BACKOFF = 0.01  # s, base of the randomized exponential wait before a retry
+MAX_BACKOFF = 0.25  # s
+# A frame is the longest reply, a page read. The reply timeout is never shorter than TIMEOUT_FRAMES of them,
+# before a retry the input is drained until the line is quiet for one
+FRAME_BYTES = PAGE_SIZE + 2
+TIMEOUT_FRAMES = 4
+TIMEOUT_STEP = 0.01  # s, timeouts are rounded up to it: with pyserial every new timeout reconfigures the port
+RESYNC_TRIES = 3
+VERIFY_REWRITES = 2  # a page that doesn't read back the same is written again this many times
+
+# RS485: silence kept on the bus before writing, so the node's transceiver is back to receive
+TURNAROUND_BITS = 20  # bit times, scale with the baud rate
+TURNAROUND_MIN = 0.0005  # s, direction switching of the transceivers
+TURNAROUND_MAX = 0.01  # s
+
 logging.basicConfig(format='%(message)s', level=logging.INFO)
 
+_NO_SESSION = object()
+
+
+def session(method):
+    """ Give the port back with the timeout it had when the outermost decorated call started"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.port_timeout is not _NO_SESSION:
+            return method(self, *args, **kwargs)
+        self.port_timeout = getattr(self.sock, "timeout", None)
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            timeout, self.port_timeout = self.port_timeout, _NO_SESSION
+            self._set_timeout(timeout)
+    return wrapper
+
+
+class FlashImage(object):
+    """ Flash content of an Intel HEX file, split in PAGE_SIZE pages (page n is at word address n * PAGE_SIZE / 2)"""
+    __slots__ = ('image', 'pages')
+
+    def __init__(self, image):
+        self.image = bytes(image)
+        self.pages = [self.image[i:i + PAGE_SIZE] for i in range(0, len(self.image), PAGE_SIZE)]
+        # Trailing erased pages hold no code, they don't need to be sent
+        while self.pages and self.pages[-1] == b'\xff' * len(self.pages[-1]):
+            self.pages.pop()
+
+    def digests(self):
+        return [page_digest(page) for page in self.pages]
+
+    def __len__(self):
+        return len(self.image)
+
+
+def page_digest(page):
+    return hashlib.blake2b(page, digest_size=8).hexdigest()
+
+
+def load_manifest(manifest):
+    """ Page digests of the last successful flash of every node: {serial number: [digest, ...]}"""
+    try:
+        with open(manifest) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return dict()
+
+
+_manifest_lock = threading.Lock()
+
+
+def save_manifest(manifest, node, digests):
+    # The fleet updater flashes a node per bus at the same time
+    with _manifest_lock:
+        data = load_manifest(manifest)
+        if digests is None:
+            data.pop(node, None)
+        else:
+            data[node] = digests
+        with open(manifest + ".tmp", "w") as f:
+            json.dump(data, f, indent=1)
+        os.replace(manifest + ".tmp", manifest)
+
+
+def boot_baudrate(node, path=BOOTLOADERS):
+    """ Recorded bootloader rate of node, None when unknown"""
+    return load_manifest(path).get(str(node))
+
+
+def record_boot_baudrate(node, baudrate, path=BOOTLOADERS):
+    save_manifest(path, str(node), baudrate)
+
+
+_images = dict()
+
+
+def parse_hex(hexfile):
+    """ Intel HEX -> FlashImage, gaps between records are filled with 0xFF (erased flash)"""
+    image = bytearray()
+    base = 0
+    with open(hexfile, "rb") as f:
+        for number, row in enumerate(f, 1):
+            row = row.strip()
+            if not row:
+                continue
+            if row[:1] != b':':
+                raise ValueError(f"{hexfile}:{number} is not an Intel HEX record")
+            record = bytes.fromhex(row[1:].decode("ascii"))
+            if sum(record) & 0xFF or len(record) != record[0] + 5:
+                raise ValueError(f"{hexfile}:{number} checksum error")
+            address = (record[1] << 8 | record[2]) + base
+            kind = record[3]
+            data = record[4:-1]
+            if kind == 0x00:
+                if len(image) < address + len(data):
+                    image.extend(b'\xff' * (address + len(data) - len(image)))
+                image[address:address + len(data)] = data
+            elif kind == 0x01:
+                break
+            elif kind == 0x02:
+                base = int.from_bytes(data, "big") << 4
+            elif kind == 0x04:
+                base = int.from_bytes(data, "big") << 16
+            # 0x03 and 0x05 are start addresses, not flash content
+    return FlashImage(image)
+
+
+def load_hex(hexfile):
+    """ parse_hex() cached by file path and modification time"""
+    st = os.stat(hexfile)
+    key = os.path.abspath(hexfile)
+    stamp = (st.st_mtime_ns, st.st_size)
+    cached = _images.get(key)
+    if cached is None or cached[0] != stamp:
+        cached = _images[key] = (stamp, parse_hex(hexfile))
+    return cached[1]
+
 
 class SimpleDude(object):
-    def __init__(self, sock, retry=9, hexfile="", mode485=False):
+    def __init__(self, sock, retry=9, hexfile="", mode485=False, adaptive=True, manifest=None):
         self.sock = sock
         self.hexfile = hexfile
+        # Default manifest of program(): every flash of a node must update it, or its entry goes stale
+        self.manifest = manifest
         self.retry = retry
         self.mode485 = mode485
+        # adaptive: derive every reply timeout from baud rate and measured latency instead of the port timeout
+        self.adaptive = adaptive
+        self.latency = dict()
+        self.retries = 0
+        self.written = 0
+        self.rewrites = 0
+        self.failed_page = None
+        # Rate the bootloader answered at in negotiate(), and the one to restore at the end
+        self.boot_baudrate = None
+        self.base_baudrate = None
+        self.turnaround = TURNAROUND_MIN
+        self.last_reply = 0.0
+        self.sent = 0.0
+        # Timeout of the port before the session, restored at its end
+        self.port_timeout = _NO_SESSION
         self.logger = logging.getLogger(__name__)
         self.handler = None
 
@@ -85,93 +265,346 @@ class SimpleDude(object):
         self.handler = handler
         self.logger.addHandler(handler)
 
+    def wire_time(self, nbytes):
+        """ Seconds to move nbytes on the serial line (8N1: 10 bits per byte)"""
+        return nbytes * 10 / (getattr(self.sock, "baudrate", None) or BAUD_RATE)
+
+    def frame_time(self):
+        return self.wire_time(FRAME_BYTES)
+
+    def reply_timeout(self, key, nbytes, attempt=0):
+        estimate = self.latency.get(key)
+        if estimate is None:
+            latency = INITIAL_LATENCY
+        else:
+            srtt, rttvar = estimate
+            latency = max(MIN_LATENCY, srtt + 4 * rttvar)
+        timeout = max(TIMEOUT_FRAMES * self.frame_time(), self.wire_time(nbytes) + latency)
+        return min(MAX_TIMEOUT, math.ceil(timeout * 2 ** attempt / TIMEOUT_STEP) * TIMEOUT_STEP)
+
+    def _set_timeout(self, timeout):
+        if getattr(self.sock, "timeout", None) != timeout:
+            self.sock.timeout = timeout
+
+    def _reply_timeout(self, key, nbytes, attempt=0):
+        """ Timeout of the port for the next reply"""
+        self._set_timeout(self.reply_timeout(key, nbytes, attempt) if self.adaptive else self.port_timeout)
+
+    def _measure(self, key, latency):
+        estimate = self.latency.get(key)
+        if estimate is None:
+            self.latency[key] = (latency, latency / 2)
+        else:
+            srtt, rttvar = estimate
+            rttvar = 0.75 * rttvar + 0.25 * abs(srtt - latency)
+            self.latency[key] = (0.875 * srtt + 0.125 * latency, rttvar)
+
+    def guard_time(self):
+        """ Bus silence needed before writing on RS485"""
+        return self.turnaround + self.wire_time(TURNAROUND_BITS / 10)
+
+    def _write(self, data):
+        if self.mode485:
+            wait = self.last_reply + self.guard_time() - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+        self.sent = time.monotonic()
+        self.sock.write(data)
+
+    def _read(self, size):
+        reply = self.sock.read(size=size)
+        if self.mode485:
+            self.last_reply = time.monotonic()
+            # Lost replies on a half duplex bus usually are collisions: leave more room to the transceivers
+            if len(reply) == size:
+                self.turnaround = max(TURNAROUND_MIN, self.turnaround * 0.9)
+            else:
+                self.turnaround = min(TURNAROUND_MAX, self.turnaround * 2)
+        return reply
+
+    def _drain(self):
+        """ Drop the input, late replies included: read until the line is quiet for a frame time"""
+        if hasattr(self.sock, "reset_input_buffer"):
+            self.sock.reset_input_buffer()
+        self._set_timeout(self.frame_time())
+        deadline = time.monotonic() + MAX_TIMEOUT
+        while self.sock.read(size=FRAME_BYTES) and time.monotonic() < deadline:
+            pass
+
+    def _resync(self):
+        """ Get back in step with the bootloader before a resend, False when it doesn't answer"""
+        for _ in range(RESYNC_TRIES):
+            self._drain()
+            self._reply_timeout(STK_GET_SYNC, len(SYNC) + 2)
+            self._write(bytes(SYNC))
+            if self._read(2) == bytes(INSINK):
+                return True
+        return False
+
+    def _exchange(self, data, size, key, attempt):
+        """ Write data and read size bytes of reply"""
+        if attempt:
+            self.retries += 1
+            time.sleep(random.uniform(0, min(MAX_BACKOFF, BACKOFF * 2 ** attempt)))
+            # A late reply to the previous attempt would be taken for the reply to this one
+            self._resync()
+        self._reply_timeout(key, len(data) + size, attempt)
+        self._write(data)
+        reply = self._read(size)
+        # Like Karn's algorithm: a reply to a retry could belong to the previous attempt
+        if self.adaptive and not attempt and len(reply) == size:
+            self._measure(key, max(0.0, time.monotonic() - self.sent - self.wire_time(len(data) + size)))
+        return reply
+
+    @session
     def spi_transaction(self, codes, bytesreply=0):
         n = 0
-        retry = True
-        tx_complete = len(codes) * 0.53 + 1
-        while retry:
-            self.logger.debug("Send %s", [hex(b) for b in codes])
-            #time.sleep(0.01)
-            # self.sock.setRTS(False)
-#            tx_start = time.time()
-            self.sock.write(codes)
-#           while (time.time() - tx_start) < (tx_complete / 1000.0):
-#               pass
-            # self.sock.setRTS(True)
-            self.logger.debug("Wait for reply")
+        probed = False
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        while True:
+            if debug:
+                self.logger.debug("Send %s", [hex(b) for b in codes])
             # Wait for bytesreply + INSYNC + OK
-            reply = self.sock.read(size=bytesreply + 2)
-            self.logger.debug("Received %s", reply)
+            reply = self._exchange(bytes(codes), bytesreply + 2, codes[0], n)
+            if debug:
+                self.logger.debug("Received %s", reply)
             if not reply or ([reply[0], reply[-1]] != INSINK):
                 if n < self.retry:
                     n += 1
                     self.logger.critical("Retry %s", n)
                     continue
+                elif not probed and self.reprobe():
+                    probed = True
+                    n = 0
+                    continue
                 else:
                     self.logger.critical("Not in sync")
                     raise Exception("Not in sync")
-            if len(reply) == 3:
-                return reply[1]
-            elif len(reply) > 3:
-                return reply[1:-1]
-            return
-    
+            return self._result(reply)
+
+    @staticmethod
+    def _result(reply):
+        if len(reply) == 3:
+            return reply[1]
+        elif len(reply) > 3:
+            return reply[1:-1]
+        return
+
+    @session
+    def spi_batch(self, commands):
+        """ Run [(codes, bytesreply), ...] with one write and one read, return the list of replies.
+
+        A command that gets a bad reply is retried, after a resync, together with the ones
+        following it. On RS485 (mode485) the bootloader would answer while we are still
+        transmitting, so the commands are sent one at a time.
+        """
+        if self.mode485:
+            return [self.spi_transaction(codes, bytesreply) for codes, bytesreply in commands]
+        results = list()
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        n = 0
+        probed = False
+        while len(results) < len(commands):
+            pending = commands[len(results):]
+            data = b"".join(bytes(codes) for codes, _ in pending)
+            if debug:
+                self.logger.debug("Send %s", [hex(b) for b in data])
+            key = tuple(codes[0] for codes, _ in pending)
+            reply = self._exchange(data, sum(bytesreply + 2 for _, bytesreply in pending), key, n)
+            if debug:
+                self.logger.debug("Received %s", reply)
+            pos = 0
+            for codes, bytesreply in pending:
+                chunk = reply[pos:pos + bytesreply + 2]
+                if len(chunk) != bytesreply + 2 or [chunk[0], chunk[-1]] != INSINK:
+                    break
+                results.append(self._result(chunk))
+                pos += len(chunk)
+            else:
+                break
+            if n >= self.retry:
+                if probed or not self.reprobe():
+                    self.logger.critical("Not in sync")
+                    raise Exception("Not in sync")
+                probed = True
+                n = 0
+            n += 1
+            if results and commands[len(results) - 1][0][0] == STK_LOAD_ADDRESS:
+                # Page commands move the address: load it again before retrying them
+                results.pop()
+            self.logger.critical("Retry %s from command %s", n, len(results))
+        return results
+
+    def wait_bootloader(self, timeout=3.0, interval=0.05):
+        """ Poll STK_GET_SYNC until the bootloader answers, True when it did within timeout seconds"""
+        deadline = time.monotonic() + timeout
+        saved = getattr(self.sock, "timeout", None)
+        try:
+            while time.monotonic() < deadline:
+                if hasattr(self.sock, "reset_input_buffer"):
+                    self.sock.reset_input_buffer()
+                self._set_timeout(interval)
+                self._write(bytes(SYNC))
+                if self._read(2) == bytes(INSINK):
+                    return True
+        finally:
+            self._set_timeout(saved)
+        return False
+
+    def _probe(self, baudrate, timeout):
+        """ Switch the port to baudrate, True if the bootloader answers a few syncs there"""
+        self.sock.baudrate = baudrate
+        self.latency.clear()
+        return self.wait_bootloader(timeout=timeout) and all(self.wait_bootloader(timeout=timeout) for _ in range(2))
+
+    def negotiate(self, baudrate=None, baudrates=BAUD_RATES, timeout=0.2):
+        """ Move the session to the rate the bootloader answers at, return it.
+
+        baudrate is the rate recorded for the node (boot_baudrate()). It is probed first, then the
+        rate of the port, then the other baudrates from the slowest: a byte at the wrong rate can
+        send the node back to its application. The port returns to its original rate with restore_baudrate().
+        """
+        if self.base_baudrate is None:
+            self.base_baudrate = self.sock.baudrate
+        known = [rate for rate in (baudrate, self.base_baudrate) if rate]
+        candidates = list(dict.fromkeys(known + sorted(baudrates)))
+        for rate in candidates:
+            if self._probe(rate, timeout):
+                self.boot_baudrate = rate
+                self.logger.info("Bootloader session at %s baud", rate)
+                return rate
+            self.logger.debug("No answer at %s baud", rate)
+        self.sock.baudrate = self.base_baudrate
+        self.boot_baudrate = None
+        self.logger.warning("Bootloader not answering, staying at %s baud", self.base_baudrate)
+        return self.base_baudrate
+
+    def reprobe(self):
+        """ After a sync error check that the bootloader still answers at the negotiated rate.
+
+        optiboot runs at the one rate it was built with, any other rate would send it back to the application.
+        """
+        if self.boot_baudrate is None:
+            return False
+        self.logger.warning("Sync lost, probing %s baud again", self.boot_baudrate)
+        return self._probe(self.boot_baudrate, INITIAL_LATENCY)
+
+    def restore_baudrate(self):
+        if self.base_baudrate is not None:
+            self.sock.baudrate = self.base_baudrate
+            self.base_baudrate = None
+            self.boot_baudrate = None
+
+    @session
     def sync(self):
         # get in self.sync with the AVR
         for i in range(3):
             self.logger.debug("Syncing")
             self.spi_transaction(SYNC)
 
+    @session
     def get_info(self):
         self.sync()
-    
-        # get the MAJOR version of the bootloader
-        self.logger.debug("Getting the HARDWARE version of arduino")
-        hardware = self.spi_transaction(GET_HARDWARE, 1)
-    
-        self.logger.info("Hardware version: %s", hex(hardware))
-    
-        # get the MAJOR version of the bootloader
-        self.logger.debug("Getting the MAJOR version of the bootloader")
-        major = self.spi_transaction(GET_SW_MAJOR, 1)
-    
-        # get the MINOR version of the bootloader
-        self.logger.debug("Getting the MINOR version of the bootloader")
-        minor = self.spi_transaction(GET_SW_MINOR, 1)
-    
-        self.logger.info("Bootloader version %s.%s", hex(major), hex(minor))
-    
-        self.logger.debug("Getting the MAJOR serial number of arduino")
-        major = self.spi_transaction(GET_SN_MAJOR, 1)
-
-        self.logger.debug("Getting the MINOR serial number of arduino")
-        minor = self.spi_transaction(GET_SN_MINOR, 1)
-
-        self.logger.info("Serial number %s", major*256 + minor)
 
-        # enter programming mode
-        self.logger.debug("Entering programming mode")
-        self.spi_transaction(ENTER_PROG_MODE)
-    
-        # get device signature
-        self.logger.debug("Getting device signature")
-        signature = self.spi_transaction(GET_SIGNATURE, 3)
-    
+        # All the queries go in a single write
+        (hardware, sw_major, sw_minor, sn_major, sn_minor, _,
+         signature, lfuse, hfuse, efuse, _) = self.spi_batch([(GET_HARDWARE, 1),
+                                                              (GET_SW_MAJOR, 1),
+                                                              (GET_SW_MINOR, 1),
+                                                              (GET_SN_MAJOR, 1),
+                                                              (GET_SN_MINOR, 1),
+                                                              (ENTER_PROG_MODE, 0),
+                                                              (GET_SIGNATURE, 3),
+                                                              (GET_SAFE_LFUSE, 1),
+                                                              (GET_SAFE_HFUSE, 1),
+                                                              (GET_SAFE_EFUSE, 1),
+                                                              (EXIT_PROG_MODE, 0)])
+
+        self.logger.info("Hardware version: %s", hex(hardware))
+        self.logger.info("Bootloader version %s.%s", hex(sw_major), hex(sw_minor))
+        self.logger.info("Serial number %s", sn_major * 256 + sn_minor)
         self.logger.info("Device signature %s-%s-%s", hex(signature[0]), hex(signature[1]), hex(signature[2]))
-    
-        self.logger.debug("Get safe fuses")
-        lfuse = self.spi_transaction(GET_SAFE_LFUSE, 1)
-        hfuse = self.spi_transaction(GET_SAFE_HFUSE, 1)
-        efuse = self.spi_transaction(GET_SAFE_EFUSE, 1)
-    
         self.logger.info("FUSES E:%s H:%s L:%s", hex(efuse), hex(hfuse), hex(lfuse))
-    
-        # leave programming mode
-        self.logger.debug("Leaving programming mode")
-        self.spi_transaction(EXIT_PROG_MODE)
-    
-    def program(self):
+
+    @session
+    def serial_number(self):
+        major, minor = self.spi_batch([(GET_SN_MAJOR, 1), (GET_SN_MINOR, 1)])
+        return major * 256 + minor
+
+    @staticmethod
+    def _load_address(address):
+        # address is in words
+        return [STK_LOAD_ADDRESS, address % 256, address // 256, CRC_EOP]
+
+    @staticmethod
+    def _read_page(size):
+        return [STK_READ_PAGE, size // 256, size % 256, FLASH_MEMORY, CRC_EOP]
+
+    @staticmethod
+    def _page(page):
+        return bytes([page]) if type(page) is int else bytes(page)
+
+    @staticmethod
+    def _prog_page(page):
+        return bytes([STK_PROG_PAGE, len(page) // 256, len(page) % 256, FLASH_MEMORY]) + page + bytes([CRC_EOP])
+
+    def compression(self):
+        """ COMPRESSION_* flags supported by the bootloader, 0 for a stock optiboot"""
+        flags = self.spi_transaction(GET_COMPRESSION, 1)
+        if flags & 0xF0 != COMPRESSION_MAGIC:
+            return 0
+        return flags & (COMPRESSION_FILL | COMPRESSION_COPY)
+
+    def _encode(self, page, flags, copies):
+        """ Shortest command writing page at the loaded address.
+
+        copies maps the content of the pages already in flash to their word address.
+        """
+        if flags & COMPRESSION_FILL and page.count(page[0]) == len(page):
+            return bytes([CSTM_PROG_FILL, len(page) // 256, len(page) % 256, FLASH_MEMORY, page[0], CRC_EOP])
+        source = copies.get(page)
+        if flags & COMPRESSION_COPY and source is not None:
+            return bytes([CSTM_PROG_COPY, len(page) // 256, len(page) % 256, FLASH_MEMORY,
+                          source % 256, source // 256, CRC_EOP])
+        return self._prog_page(page)
+
+    def load_address(self, address):
+        self.spi_transaction(self._load_address(address))
+
+    def read_page(self, size):
+        return self._page(self.spi_transaction(self._read_page(size), size))
+
+    @session
+    def program(self, differential=False, manifest=None, verify=False, compress=False):
+        """ Write the hex file, return False when a written page doesn't read back the same.
+
+        differential: send only the pages that changed. They are found comparing with the page
+        digests stored in the manifest for this node when available, reading the flash back otherwise.
+        One of the pages the manifest gives as unchanged is read back anyway: on a mismatch the
+        manifest is ignored. Nodes with the serial number of a stock bootloader never use the manifest.
+        manifest: json file updated with the page digests after a successful flash (self.manifest by default).
+        verify: read every page back right after writing it, write it again up to VERIFY_REWRITES
+        times when it differs (a bit flipped on the line) and then stop, the word address of that page
+        is left in self.failed_page.
+        compress: send uniform pages and copies of earlier pages with the custom fill/copy commands,
+        when the bootloader supports them (plain STK_PROG_PAGE otherwise).
+        """
+        image = load_hex(self.hexfile)
+        pages = image.pages
         self.sync()
+        manifest = manifest or self.manifest
+        node = None
+        if manifest:
+            serial_number = self.serial_number()
+            if serial_number == STOCK_SERIAL_NUMBER:
+                self.logger.warning("Serial number %s is not unique, the manifest is not used", serial_number)
+                manifest = None
+            else:
+                node = str(serial_number)
+        known = load_manifest(manifest).get(node) if differential and manifest else None
+        if manifest:
+            # Until this flash is complete the node content is unknown
+            save_manifest(manifest, node, None)
         # enter programming mode
         # self.logger.info("Chip erase")
         # self.spi_transaction(CHIP_ERASE)
@@ -179,101 +612,111 @@ class SimpleDude(object):
         # enter programming mode
         self.logger.debug("Entering programming mode")
         self.spi_transaction(ENTER_PROG_MODE)
+        flags = self.compression() if compress else 0
+        if compress and not flags:
+            self.logger.info("Bootloader without compression, using plain pages")
+        if known is not None and not self._check_manifest(pages, known):
+            self.logger.warning("Node %s doesn't match its manifest, reading every page back", node)
+            known = None
 
-        # start with page address 0
-        address = 0
         prg_length = 0
-        data = list()
-
-        # open the hex file
-        with open(self.hexfile, "rb") as hexfile:
-            while True:
-                # the hex in the file is represented in char
-                # so we have to merge 2 chars into one byte
-                # 16 bytes in a line, 16 * 8 = 128
-                # for i in range(8):
-                row = hexfile.readline()
-                # check EOF
-                # just take the program data
-                if row[7:9] != b'01':
-                    hexrow = row[9:][:-4]
-                    data.extend([int(hexrow[b:b + 2], 16) for b in range(len(hexrow))[::2]])
-                    self.logger.debug("ROW: %s - len data: %s", row, len(data))
-                if not data:
-                    self.logger.debug("End program")
+        skipped = 0
+        sent = plain = 0
+        copies = dict()
+        self.written = 0
+        self.rewrites = 0
+        self.failed_page = None
+        for number, page in enumerate(pages):
+            address = number * PAGE_SIZE // 2
+            if differential:
+                if known is not None:
+                    unchanged = number < len(known) and known[number] == page_digest(page)
+                else:
+                    _, current = self.spi_batch([(self._load_address(address), 0),
+                                                 (self._read_page(len(page)), len(page))])
+                    unchanged = self._page(current) == page
+                if unchanged:
+                    self.logger.debug("Page %s:%s unchanged", address // 256, address % 256)
+                    skipped += 1
+                    copies.setdefault(page, address)
+                    continue
+            self.logger.info("Sending page %s:%s block size:%s", address // 256, address % 256, len(page))
+            write = self._encode(page, flags, copies) if flags else self._prog_page(page)
+            sent += len(write)
+            plain += len(page) + 5
+            for attempt in range(1 + (VERIFY_REWRITES if verify else 0)):
+                if attempt:
+                    self.rewrites += 1
+                    self.logger.warning("Page %s:%s differ from Hex file, writing it again",
+                                        address // 256, address % 256)
+                # The bootloader doesn't read the UART while it writes the page: nothing may follow the page command
+                self.spi_batch([(self._load_address(address), 0), (write, 0)])
+                if not verify:
+                    break
+                _, current = self.spi_batch([(self._load_address(address), 0),
+                                             (self._read_page(len(page)), len(page))])
+                if self._page(current) == page:
                     break
-                if len(data) >= 128 or row[7:9] == b'01':
-                    size = len(data[:128])
-                    prg_length += size
-                    # load page address
-                    self.logger.debug("Sending page address")
-
-                    # calculate page address
-                    laddress = address % 256
-                    haddress = int(address / 256)
-                    address += 64
-
-                    self.spi_transaction([STK_LOAD_ADDRESS, laddress, haddress, CRC_EOP])
-                    self.logger.info("Sending page {}:{} block size:{}".format(haddress, laddress, size))
-                    self.logger.debug("Data:{}".format(list(map(hex, data[:128]))))
-                    self.spi_transaction([STK_PROG_PAGE, 0, size, FLASH_MEMORY] + data[:128] + [CRC_EOP])
-                    data = data[128:]
+            else:
+                self.logger.error("Error! Page %s:%s differ from Hex file", address // 256, address % 256)
+                self.failed_page = address
+                break
+            prg_length += len(page)
+            self.written = prg_length
+            copies.setdefault(page, address)
 
         # leave programming mode
         self.logger.debug("Leaving programming mode")
         self.spi_transaction(EXIT_PROG_MODE)
-        self.logger.info("Program size %s bytes", prg_length)
+        if self.failed_page is not None:
+            return False
+        if manifest:
+            save_manifest(manifest, node, image.digests())
+        self.logger.info("Program size %s bytes, %s of %s pages unchanged", prg_length, skipped, len(pages))
+        if flags:
+            self.logger.info("Page commands %s bytes, %s without compression", sent, plain)
+        return True
 
+    def _check_manifest(self, pages, known):
+        """ Read back a random page the manifest gives as unchanged, False when it is not in flash"""
+        unchanged = [number for number, page in enumerate(pages)
+                     if number < len(known) and known[number] == page_digest(page)]
+        if not unchanged:
+            return True
+        number = random.choice(unchanged)
+        _, current = self.spi_batch([(self._load_address(number * PAGE_SIZE // 2), 0),
+                                     (self._read_page(len(pages[number])), len(pages[number]))])
+        return self._page(current) == pages[number]
+
+    def program_and_verify(self, differential=False, manifest=None):
+        """ program() and verify() in a single pass over the pages"""
+        return self.program(differential=differential, manifest=manifest, verify=True)
+
+    @session
     def verify(self):
+        pages = load_hex(self.hexfile).pages
         self.sync()
         # enter programming mode
         self.logger.debug("Entering programming mode")
         self.spi_transaction(ENTER_PROG_MODE)
-    
-        # start with page address 0
-        address = 0
-    
-        # open the hex file
-    
-        with open(self.hexfile, "rb") as hexfile:
-            while True:
-                # calculate page address
-                laddress = address % 256
-                haddress = int(address / 256)
-                address += 64
-    
-                # load page address
-                self.logger.debug("Sending page address")
-                self.spi_transaction([STK_LOAD_ADDRESS, laddress, haddress, CRC_EOP])
-    
-                data = list()
-                # the hex in the file is represented in char
-                # so we have to merge 2 chars into one byte
-                # 16 bytes in a line, 16 * 8 = 128
-                for i in range(8):
-                    # just take the program data
-                    hexrow = hexfile.readline()[9:][:-4]
-                    data.extend([int(hexrow[b:b + 2], 16) for b in range(len(hexrow))[::2]])
-    
-                size = len(data)
-                # half the size
-                self.logger.info("Reading program page %s:%s", haddress, laddress)
-                page = self.spi_transaction([STK_READ_PAGE, 0, 0x80, FLASH_MEMORY, CRC_EOP], 0x80)
-    
-                if data != page[:len(data)]:
-                    self.logger.error("Error! Page %s:%s differ from Hex file", haddress, laddress)
-                    # leave programming mode
-                    self.logger.debug("Leaving programming mode")
-                    self.spi_transaction(EXIT_PROG_MODE)
-                    return False
-
-                # FIX: Allineare con program
-                if size != 0x80:
-                    self.logger.info("Program check OK.")
-                    # leave programming mode
-                    self.logger.debug("Leaving programming mode")
-                    self.spi_transaction(EXIT_PROG_MODE)
-                    return True
+
+        result = True
+        for number, page in enumerate(pages):
+            address = number * PAGE_SIZE // 2
+            self.logger.debug("Sending page address")
+            self.load_address(address)
+            self.logger.info("Reading program page %s:%s", address // 256, address % 256)
+            if self.read_page(len(page)) != page:
+                self.logger.error("Error! Page %s:%s differ from Hex file", address // 256, address % 256)
+                result = False
+                break
+        else:
+            self.logger.info("Program check OK.")
+
+        # leave programming mode
+        self.logger.debug("Leaving programming mode")
+        self.spi_transaction(EXIT_PROG_MODE)
+        return result
 
 
 if __name__ == '__main__':
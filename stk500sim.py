@@ -0,0 +1,387 @@
+""" Software optiboot target: a serial port look-alike that answers STK500v1 like the Domuino bootloader.
+
+Optiboot(compression=True) also implements the custom fill/copy page commands of the
+compression build (compile_bootloader(..., compression=True)), so SimpleDude can be tested
+without hardware:
+
+    target = Optiboot(compression=True)
+    SimpleDude(target, hexfile="domuino.hex").program(compress=True)
+
+With throttle=True the bytes take their time on the line at the port baudrate, latency adds the
+bootloader processing time to every reply and error_rate flips a random bit of that fraction of
+the bytes in both directions. Like the real chip, the target doesn't read the UART while a page is
+written (page_write seconds, STK_OK is sent at the end): only RX_BUFFER bytes survive that time.
+PtyServer serves a target on a pseudo terminal for the tools that open a port by name. Run the module to benchmark SimpleDude:
+
+    python stk500sim.py domuino.hex -b 38400 115200 -l 0.002 -e 0.0001
+"""
+import os
+import time
+import random
+import logging
+import argparse
+import threading
+from collections import Counter, deque
+
+from simpledude import (STK_OK, STK_INSYNC, CRC_EOP, STK_GET_SYNC, STK_GET_SIGN_ON, STK_GET_PARAMETER,
+                        STK_SET_DEVICE, STK_SET_DEVICE_EXT, STK_LOAD_ADDRESS, STK_UNIVERSAL, STK_PROG_PAGE,
+                        STK_READ_PAGE, STK_READ_SIGN, STK_SW_MAJOR, STK_SW_MINOR, CSTM_SN_MAJOR, CSTM_SN_MINOR,
+                        CSTM_COMPRESSION, CSTM_PROG_FILL, CSTM_PROG_COPY, COMPRESSION_MAGIC, COMPRESSION_FILL,
+                        COMPRESSION_COPY, BAUD_RATE)
+
+LOGGER = logging.getLogger(__name__)
+
+FLASH_SIZE = 16 * 1024  # ATmega168
+SIGNATURE = b'\x1e\x94\x0b'
+OPTIBOOT_MAJVER = 6
+OPTIBOOT_MINVER = 2
+PAGE_WRITE = 0.0045  # s, erase and write of a flash page
+RX_BUFFER = 3  # bytes, USART receive FIFO and shift register
+
+# Bytes following the command byte, CRC_EOP excluded (the page commands add their size)
+ARGUMENTS = {
+    STK_GET_PARAMETER: 1,
+    STK_SET_DEVICE: 20,
+    STK_SET_DEVICE_EXT: 5,
+    STK_LOAD_ADDRESS: 2,
+    STK_UNIVERSAL: 4,
+    STK_PROG_PAGE: 3,
+    STK_READ_PAGE: 3,
+}
+COMPRESSION_ARGUMENTS = {
+    CSTM_PROG_FILL: 4,
+    CSTM_PROG_COPY: 5,
+}
+
+
+class Optiboot(object):
+    """ In memory STK500v1 target with the pyserial calls used by SimpleDude.
+
+    boot_baudrate: the target only understands the port at this rate (None: at any rate), bytes sent
+    at another rate are garbage to it. Like optiboot, the target resets into the application at the
+    first command it can't parse and ignores everything until start_bootloader().
+    """
+
+    def __init__(self, serial_number=1, compression=False, flash=None, latency=0.0, throttle=False,
+                 error_rate=0.0, boot_baudrate=None, seed=None, page_write=PAGE_WRITE):
+        self.flash = bytearray(flash or b'\xff' * FLASH_SIZE)
+        self.serial_number = serial_number
+        self.compression = compression
+        self.latency = latency
+        self.throttle = throttle
+        self.error_rate = error_rate
+        self.boot_baudrate = boot_baudrate
+        self.random = random.Random(seed)
+        self.address = 0
+        self.request = bytearray()
+        # Replies on their way to the host: [time of the first byte, seconds per byte, bytes]
+        self.reply = deque()
+        self.line_free = 0.0
+        self.page_write = page_write
+        # End of the page write in progress, bytes received meanwhile
+        self.busy_until = 0.0
+        self.held = 0
+        self.overruns = 0
+        self.baudrate = BAUD_RATE
+        self.timeout = 1
+        self.name = "optiboot"
+        self.commands = Counter()
+        self.in_bootloader = True
+        self.resets = 0
+        self.errors = 0
+
+    def byte_time(self):
+        return 10 / self.baudrate if self.throttle else 0.0
+
+    def _noise(self, data):
+        if not self.error_rate:
+            return data
+        data = bytearray(data)
+        for i in range(len(data)):
+            if self.random.random() < self.error_rate:
+                data[i] ^= 1 << self.random.randrange(8)
+                self.errors += 1
+        return data
+
+    # Serial port interface
+    def write(self, data):
+        if not self.in_bootloader or not data:
+            return len(data)
+        if self.boot_baudrate and self.baudrate != self.boot_baudrate:
+            self.reset()
+            return len(data)
+        byte_time = self.byte_time()
+        start = max(time.monotonic(), self.line_free)
+        self.line_free = start + len(data) * byte_time
+        for i, byte in enumerate(self._noise(data)):
+            arrived = start + (i + 1) * byte_time
+            if arrived < self.busy_until:
+                if self.held >= RX_BUFFER:
+                    self.overruns += 1
+                    continue
+                self.held += 1
+            self.request.append(byte)
+            # The command runs when its last byte is read, after the page write in progress
+            self._command(max(arrived, self.busy_until))
+        return len(data)
+
+    def _send(self, reply, received):
+        byte_time = self.byte_time()
+        ready = received + self.latency + byte_time
+        if self.reply:
+            first, previous_time, previous = self.reply[-1]
+            ready = max(ready, first + len(previous) * previous_time)
+        self.reply.append([ready, byte_time, bytearray(self._noise(reply))])
+
+    def _available(self, now):
+        count = 0
+        for ready, byte_time, reply in self.reply:
+            if now < ready:
+                break
+            arrived = len(reply) if not byte_time else min(len(reply), int((now - ready) / byte_time) + 1)
+            count += arrived
+            if arrived < len(reply):
+                break
+        return count
+
+    def _take(self, size):
+        data = bytearray()
+        while self.reply and len(data) < size:
+            chunk = self.reply[0]
+            taken = chunk[2][:size - len(data)]
+            data += taken
+            if len(taken) == len(chunk[2]):
+                self.reply.popleft()
+            else:
+                chunk[0] += len(taken) * chunk[1]
+                del chunk[2][:len(taken)]
+        return bytes(data)
+
+    def read(self, size=1):
+        now = time.monotonic()
+        deadline = now + (self.timeout if self.timeout is not None else 3600)
+        while True:
+            available = self._available(now)
+            if available >= size or now >= deadline:
+                return self._take(min(size, available))
+            # Sleep until the missing bytes arrive or the timeout expires
+            wake = deadline
+            if self.reply:
+                ready, byte_time, reply = self.reply[0]
+                wake = min(deadline, max(ready, now) + (size - available - 1) * byte_time)
+            time.sleep(max(0.0, wake - now))
+            now = time.monotonic()
+
+    def readinto(self, buffer):
+        reply = self.read(min(len(buffer), self.in_waiting))
+        buffer[:len(reply)] = reply
+        return len(reply)
+
+    @property
+    def in_waiting(self):
+        return self._available(time.monotonic())
+
+    def reset_input_buffer(self):
+        # What has not arrived yet will still arrive
+        self._take(self.in_waiting)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    # Bootloader
+    def _length(self, request):
+        code = request[0]
+        arguments = ARGUMENTS.get(code)
+        if arguments is None and self.compression:
+            arguments = COMPRESSION_ARGUMENTS.get(code)
+        if arguments is None:
+            # optiboot answers every other command with an empty reply
+            return 2
+        if code == STK_PROG_PAGE:
+            if len(request) < 3:
+                return None
+            arguments += request[1] * 256 + request[2]
+        return arguments + 2
+
+    def _command(self, received):
+        """ Execute the request when it is a complete command, False when more bytes are needed"""
+        length = self._length(self.request)
+        if length is None or len(self.request) < length:
+            return False
+        command = bytes(self.request)
+        self.request.clear()
+        if command[-1] != CRC_EOP:
+            self.reset()
+            return False
+        self.commands[command[0]] += 1
+        reply = bytes([STK_INSYNC]) + self.execute(command) + bytes([STK_OK])
+        if command[0] in (STK_PROG_PAGE, CSTM_PROG_FILL, CSTM_PROG_COPY):
+            received += self.page_write
+            self.busy_until = received
+            self.held = 0
+        self._send(reply, received)
+        return True
+
+    def reset(self):
+        """ optiboot lets the watchdog reset the chip, the application starts"""
+        self.resets += 1
+        self.in_bootloader = False
+        self.request.clear()
+        self.address = 0
+
+    def start_bootloader(self):
+        """ Back to the bootloader, as after the PROGRAM command of the application"""
+        self.in_bootloader = True
+        self.busy_until = 0.0
+
+    def parameter(self, code):
+        if code == STK_SW_MAJOR:
+            return OPTIBOOT_MAJVER
+        if code == STK_SW_MINOR:
+            return OPTIBOOT_MINVER
+        if code == CSTM_SN_MAJOR:
+            return self.serial_number // 256
+        if code == CSTM_SN_MINOR:
+            return self.serial_number % 256
+        if code == CSTM_COMPRESSION and self.compression:
+            return COMPRESSION_MAGIC | COMPRESSION_FILL | COMPRESSION_COPY
+        return 0x03
+
+    def program_page(self, data):
+        # The page write works on whole flash pages, data beyond the flash wraps like the real address counter
+        for i, byte in enumerate(data):
+            self.flash[(self.address + i) % len(self.flash)] = byte
+
+    def execute(self, command):
+        code = command[0]
+        if code == STK_GET_PARAMETER:
+            return bytes([self.parameter(command[1])])
+        if code == STK_LOAD_ADDRESS:
+            self.address = (command[1] + command[2] * 256) * 2
+        elif code == STK_UNIVERSAL:
+            return b'\x00'
+        elif code == STK_READ_SIGN:
+            return SIGNATURE
+        elif code == STK_GET_SIGN_ON:
+            return b''
+        elif code == STK_READ_PAGE:
+            size = command[1] * 256 + command[2]
+            return bytes(self.flash[self.address:self.address + size])
+        elif code == STK_PROG_PAGE:
+            self.program_page(command[4:-1])
+        elif code == CSTM_PROG_FILL:
+            self.program_page(bytes([command[4]]) * (command[1] * 256 + command[2]))
+        elif code == CSTM_PROG_COPY:
+            source = (command[4] + command[5] * 256) * 2
+            self.program_page(bytes(self.flash[source:source + command[1] * 256 + command[2]]))
+        elif code != STK_GET_SYNC:
+            LOGGER.debug("Command %s ignored", hex(code))
+        return b''
+
+
+class PtyServer(threading.Thread):
+    """ Serve a target on a pseudo terminal, open `port` with serial.Serial to talk to it"""
+
+    def __init__(self, target):
+        super().__init__(name="PtyServer", daemon=True)
+        import pty
+        import tty
+
+        self.target = target
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        tty.setraw(self.master)
+        self.port = os.ttyname(self.slave)
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def run(self):
+        import select
+
+        while not self.stopped.is_set():
+            readable, _, _ = select.select([self.master], [], [], 0.001)
+            if readable:
+                self.target.write(os.read(self.master, 4096))
+            waiting = self.target.in_waiting
+            if waiting:
+                os.write(self.master, self.target.read(waiting))
+
+
+def benchmark(hexfile, baudrate=BAUD_RATE, latency=0.0, error_rate=0.0, compress=False, mode485=False,
+              use_pty=False, seed=None):
+    """ Flash and verify hexfile on a simulated target, return the measures"""
+    import serial
+    from simpledude import SimpleDude, PAGE_SIZE
+
+    target = Optiboot(compression=compress, latency=latency, throttle=True, error_rate=error_rate, seed=seed)
+    target.baudrate = baudrate
+    server = None
+    port = target
+    if use_pty:
+        server = PtyServer(target)
+        server.start()
+        port = serial.Serial(server.port, baudrate=baudrate, timeout=1)
+    dude = SimpleDude(port, hexfile=hexfile, mode485=mode485)
+    start = time.monotonic()
+    try:
+        ok = dude.program(verify=True, compress=compress)
+        status = "ok" if ok else "verify"
+    except Exception:
+        ok = False
+        # A garbled command resets optiboot into the application: the flash can't go on
+        status = "sync" if target.in_bootloader else "reset"
+    seconds = time.monotonic() - start
+    if server:
+        port.close()
+        server.stop()
+    return {'hexfile': os.path.basename(hexfile), 'baudrate': baudrate, 'ok': ok, 'status': status,
+            'seconds': seconds, 'pages/s': dude.written / PAGE_SIZE / seconds, 'retries': dude.retries,
+            'rewrites': dude.rewrites, 'errors': target.errors}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark SimpleDude on a simulated optiboot")
+    parser.add_argument("hexfiles", nargs="+")
+    parser.add_argument("-b", "--baudrates", type=int, nargs="+", default=[BAUD_RATE])
+    parser.add_argument("-l", "--latency", type=float, default=0.0, help="Bootloader reply latency (s)")
+    parser.add_argument("-e", "--error-rate", type=float, default=0.0, help="Fraction of bytes with a bit flipped")
+    parser.add_argument("-r", "--runs", type=int, default=1)
+    parser.add_argument("-Z", "--compress", action="store_true", help="Compression build of the bootloader")
+    parser.add_argument("--mode485", action="store_true", help="One command per transaction")
+    parser.add_argument("--pty", action="store_true", help="Go through a pseudo terminal")
+    args = parser.parse_args()
+
+    # Retries and rewrites are in the table
+    logging.getLogger("simpledude").setLevel(logging.CRITICAL + 1)
+    print(f"{'hexfile':>20} {'baud':>7} {'run':>4} {'status':>6} {'seconds':>8} {'pages/s':>8} {'retries':>7} "
+          f"{'rewrite':>7} {'errors':>6}")
+    for hexfile in args.hexfiles:
+        for baudrate in args.baudrates:
+            results = list()
+            for run in range(args.runs):
+                result = benchmark(hexfile, baudrate, args.latency, args.error_rate, args.compress, args.mode485,
+                                   args.pty, seed=run)
+                results.append(result)
+                print(f"{result['hexfile']:>20} {baudrate:>7} {run:>4} {result['status']:>6} "
+                      f"{result['seconds']:>8.2f} {result['pages/s']:>8.1f} {result['retries']:>7} "
+                      f"{result['rewrites']:>7} {result['errors']:>6}")
+            # The times of the aborted runs say nothing about the flash time
+            done = [result for result in results if result['ok']]
+            aborted = len(results) - len(done)
+            if done:
+                print(f"{result['hexfile']:>20} {baudrate:>7} {'avg':>4} {f'{len(done)} ok':>6} "
+                      f"{sum(r['seconds'] for r in done) / len(done):>8.2f} "
+                      f"{sum(r['pages/s'] for r in done) / len(done):>8.1f} "
+                      f"{sum(r['retries'] for r in done) / len(done):>7.1f} "
+                      f"{sum(r['rewrites'] for r in done) / len(done):>7.1f}"
+                      f"{'':>7}{f'  {aborted} aborted' if aborted else ''}")
+            elif aborted:
+                print(f"{result['hexfile']:>20} {baudrate:>7} {'avg':>4} all {aborted} runs aborted")